@@ -0,0 +1,178 @@
+import csv
+import logging
+import lazy_imports
+
+# pyarrow is only imported for Parquet/Arrow exports
+pa = lazy_imports.lazy_import('pyarrow')
+
+FILE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def check_headers(df, headers):
+    """Warns if the header column list does not match the DataFrame header columns."""
+
+    if headers and not len(df.columns.to_list()) == len(headers):
+        logging.warning('Export error: Header column list does not match DataFrame header columns.')
+
+
+def write_csv(df, filename, headers=None):
+    """
+    Export DataFrame to CSV. The optional 'headers' row (ie: full path names) is written before the DataFrame header.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame to export
+    filename : str
+        CSV filename, or file object
+    headers : list[str]
+        Optional. Column names written as the first CSV row
+    """
+
+    check_headers(df, headers)
+
+    if isinstance(filename, str):
+        with open(filename, 'w') as f:
+            write_csv(df, f, headers)
+        return
+
+    if headers:
+        writer = csv.writer(filename)
+        writer.writerow(headers)
+
+    df.to_csv(filename, index=False, header=True)
+
+
+def dataframe_to_arrow(df, headers=None):
+    """
+    Convert DataFrame to an Arrow Table. For population statistic columns ('pop_name | stat'), the full path name
+    from 'headers', the pop name and the stat are stored as Arrow field metadata.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame to convert
+    headers : list[str]
+        Optional. Full path names of the DataFrame columns
+
+    Returns
+    ----------
+    table : object
+        Arrow Table
+    """
+
+    check_headers(df, headers)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if not headers:
+        headers = df.columns.to_list()
+
+    fields = []
+    for field, col, path_name in zip(table.schema, df.columns, headers):
+        if ' | ' in col:
+            pop_name, stat = col.split(' | ', 1)
+            field = field.with_metadata({'path_name': path_name, 'pop_name': pop_name, 'stat': stat})
+        fields.append(field)
+
+    schema = pa.schema(fields, metadata=table.schema.metadata)
+
+    return table.cast(schema)
+
+
+def write_parquet(df, filename, headers=None, partition_cols=None, compression='snappy'):
+    """
+    Export DataFrame to Parquet, with full path names and pop names stored as column metadata.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame to export
+    filename : str
+        Parquet filename, or directory name if 'partition_cols' is given
+    headers : list[str]
+        Optional. Full path names of the DataFrame columns
+    partition_cols : list[str]
+        Optional. Metadata columns to partition the export by (ie: Treatment Group, Treatment Batch)
+    compression : str
+        Parquet compression: 'snappy', 'zstd', 'gzip', 'brotli', 'lz4' or 'none'
+    """
+
+    import pyarrow.parquet as pq
+
+    table = dataframe_to_arrow(df, headers)
+
+    if partition_cols:
+        pq.write_to_dataset(table, filename, partition_cols=partition_cols, compression=compression,
+                            existing_data_behavior='delete_matching')
+    else:
+        pq.write_table(table, filename, compression=compression)
+
+
+def write_arrow(df, filename, headers=None, partition_cols=None, compression=None):
+    """
+    Export DataFrame to Arrow IPC (Feather V2), with full path names and pop names stored as column metadata.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame to export
+    filename : str
+        Arrow filename, or directory name if 'partition_cols' is given
+    headers : list[str]
+        Optional. Full path names of the DataFrame columns
+    partition_cols : list[str]
+        Optional. Metadata columns to partition the export by (ie: Treatment Group, Treatment Batch)
+    compression : str
+        Arrow IPC compression: 'lz4', 'zstd' or None
+    """
+
+    import pyarrow.dataset as ds
+
+    table = dataframe_to_arrow(df, headers)
+
+    if partition_cols:
+        file_format = ds.IpcFileFormat()
+        ds.write_dataset(table, filename, format=file_format, partitioning=partition_cols,
+                         partitioning_flavor='hive', existing_data_behavior='delete_matching',
+                         file_options=file_format.make_write_options(compression=compression))
+    else:
+        with pa.OSFile(filename, 'wb') as sink:
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+
+
+def export_dataframe(df, filename, headers=None, file_format='csv', partition_cols=None, compression=None):
+    """
+    Export DataFrame to CSV, Parquet or Arrow IPC.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame to export
+    filename : str
+        Export filename
+    headers : list[str]
+        Optional. Full path names of the DataFrame columns. Written as the first CSV row, or stored as
+        column metadata for Parquet/Arrow
+    file_format : str
+        'csv', 'parquet' or 'arrow'
+    partition_cols : list[str]
+        Optional. Parquet/Arrow only. Metadata columns to partition the export by
+    compression : str
+        Optional. Parquet/Arrow only. Compression codec (Parquet default is 'snappy')
+    """
+
+    if file_format == 'csv':
+        if partition_cols or compression:
+            logging.warning('Partitioning and compression are not used for CSV export.')
+        write_csv(df, filename, headers)
+
+    elif file_format == 'parquet':
+        write_parquet(df, filename, headers, partition_cols, compression or 'snappy')
+
+    elif file_format == 'arrow':
+        write_arrow(df, filename, headers, partition_cols, compression)
+
+    else:
+        raise ValueError('Unknown export file format: ' + file_format)
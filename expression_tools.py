@@ -0,0 +1,153 @@
+import ast
+import functools
+import lazy_imports
+
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+
+# Functions that reference a flowtree population by 'pop_name' or path, and the node attribute they use
+POPULATION_FUNCTIONS = {'count': 'counts', 'freq': 'freq_of_parent'}
+
+# Math functions allowed in expressions
+MATH_FUNCTIONS = {'log': 'log', 'log2': 'log2', 'log10': 'log10', 'sqrt': 'sqrt', 'abs': 'abs'}
+
+BINARY_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)
+UNARY_OPERATORS = (ast.UAdd, ast.USub)
+
+
+class _PopulationReferences(ast.NodeTransformer):
+    """Replaces count('...') and freq('...') calls with array variables, and checks the allowed syntax."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.references = []
+
+    def error(self, message):
+        return ValueError('Invalid expression "' + self.expression + '": ' + message)
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, BINARY_OPERATORS):
+            raise self.error('operator ' + type(node.op).__name__ + ' is not allowed')
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, UNARY_OPERATORS):
+            raise self.error('operator ' + type(node.op).__name__ + ' is not allowed')
+        node.operand = self.visit(node.operand)
+        return node
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise self.error('only numbers and quoted population names are allowed')
+        return node
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords or len(node.args) != 1:
+            raise self.error('functions take one argument, ie: count(\'CD8+ T Cells\')')
+
+        func = node.func.id
+        if func in POPULATION_FUNCTIONS:
+            arg = node.args[0]
+            if not (isinstance(arg, ast.Constant) and isinstance(arg.value, str)):
+                raise self.error(func + '() takes a quoted population name or path')
+
+            reference = (func, arg.value)
+            if reference not in self.references:
+                self.references.append(reference)
+            return ast.copy_location(ast.Name(id='_ref' + str(self.references.index(reference)), ctx=ast.Load()),
+                                     node)
+
+        if func in MATH_FUNCTIONS:
+            node.args = [self.visit(node.args[0])]
+            return node
+
+        raise self.error('unknown function ' + func + '()')
+
+    def generic_visit(self, node):
+        raise self.error(type(node).__name__ + ' is not allowed')
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_expression(expression):
+    """
+    Parses and compiles an expression over flowtree populations. Compiled expressions are cached.
+
+    Expressions use count('<pop_name or path>') and freq('<pop_name or path>') (Freq of Parent), numbers,
+    + - * / ** and the functions log, log2, log10, sqrt and abs. For example:
+    "count('CD8+ T Cells') / count('CD4+ T Cells')" or "1e6 * count('Tregs') / count('Live')"
+
+    Parameters
+    ----------
+    expression : str
+        Expression to compile
+
+    Returns
+    ----------
+    code : object
+        Compiled expression, evaluated with one array variable per reference
+    references : tuple
+        (function, population) references of the expression, in the order of the array variables
+    """
+
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as err:
+        raise ValueError('Invalid expression "' + expression + '": ' + str(err.msg))
+
+    transformer = _PopulationReferences(expression)
+    tree = ast.fix_missing_locations(transformer.visit(tree))
+
+    return compile(tree, '<expression>', 'eval'), tuple(transformer.references)
+
+
+def evaluate_expressions(root, expressions):
+    """
+    Evaluates expressions over the populations of a flowtree in one batch. Each referenced population array is
+    collected once, and expressions are evaluated as vectorized array operations over the flowtree samples.
+
+    Parameters
+    ----------
+    root : object
+        PopNode object, flowtree to evaluate the expressions on
+    expressions : list[str] or dict
+        Expressions (see 'compile_expression'), or dict of column name: expression
+
+    Returns
+    ----------
+    df_out : object
+        DataFrame of the flowtree sample metadata, with one column per expression
+    """
+
+    if not isinstance(expressions, dict):
+        expressions = {expression: expression for expression in expressions}
+
+    plans = {name: compile_expression(expression) for name, expression in expressions.items()}
+
+    # Collect each referenced population array once
+    arrays = {}
+    for _, references in plans.values():
+        for func, population in references:
+            if (func, population) not in arrays:
+                node = root.find_path_or_popname(population)
+                arrays[(func, population)] = node.get_data_array(POPULATION_FUNCTIONS[func])
+
+    math_functions = {name: getattr(np, func) for name, func in MATH_FUNCTIONS.items()}
+
+    df_out = root.get_sample_metadata()
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, (code, references) in plans.items():
+            namespace = dict(math_functions)
+            namespace.update({'_ref' + str(i): arrays[ref] for i, ref in enumerate(references)})
+            result = eval(code, {'__builtins__': {}}, namespace)
+            results[name] = np.broadcast_to(np.asarray(result, dtype='float64'), (len(df_out),))
+
+    df_out = pd.concat([df_out, pd.DataFrame(results, index=df_out.index)], axis=1)
+
+    return df_out
@@ -1,7 +1,14 @@
-import bigtree
+import export_tools
+import expression_tools
+import lazy_imports
 import logging
-import pandas as pd
-import csv
+import threading
+
+# pandas is imported on first use. It is registered before bigtree, which imports pandas for its DataFrame tools
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+
+import bigtree
 
 # def my_decorator(func):
 #     def wrapper(*args, **kwargs):
@@ -51,6 +58,70 @@ def filter_node(node, var_column, keep_values=None, drop_values=None):
         del df, df_temp
 
 
+def check_memory_budget(stage, nbytes, memory_budget):
+    """
+    Reports the estimated memory of a processing stage, and warns if the estimate exceeds the memory budget.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the processing stage
+    nbytes : int
+        Estimated memory of the stage, in bytes
+    memory_budget : float
+        Memory budget, in MB. Nothing is checked if None
+
+    Returns
+    ----------
+    exceeded : bool
+        True if the estimate exceeds the memory budget
+    """
+
+    if memory_budget is None:
+        return False
+
+    memory_mb = nbytes / 1e6
+    print(stage + ' memory estimate: ' + str(round(memory_mb, 1)) + ' MB')
+
+    exceeded = memory_mb > memory_budget
+    if exceeded:
+        logging.warning(stage + ' memory estimate exceeds the memory budget of ' + str(memory_budget) + ' MB.')
+
+    return exceeded
+
+
+def propagate_counts(freq, parent_counts):
+    """
+    Calculates population counts from the Freq of Parent (%) and the parent population counts, in float64.
+    Counts are stored in float64 (also in memory-budget mode), so rounding errors do not accumulate down the
+    flowtree.
+    Sparse Freq of Parent columns, of populations that were not measured in every batch (masked mode, see
+    'import_tools.preprocess_csvs'), are calculated at the measured rows only.
+
+    Parameters
+    ----------
+    freq : Series
+        'Data' column of the population Freq of Parent (%)
+    parent_counts : Series
+        Parent population counts (or Event Count), with rows in the order of 'freq'
+
+    Returns
+    ----------
+    counts : object
+        Population counts in float64 (sparse float64 in masked mode)
+    """
+
+    if isinstance(freq.dtype, pd.SparseDtype):
+        positions = freq.array.sp_index.indices
+        counts = np.full(len(freq), np.nan)
+        counts[positions] = (freq.array.sp_values.astype('float64')
+                             * parent_counts.iloc[positions].to_numpy(dtype='float64')) / 100
+
+        return pd.arrays.SparseArray(counts, fill_value=np.nan, dtype=pd.SparseDtype('float64', np.nan))
+
+    return (freq.to_numpy(dtype='float64') * parent_counts.to_numpy(dtype='float64')) / 100
+
+
 class PopNode(bigtree.Node):
 
     def __init__(self, name, **kwargs):
@@ -58,6 +129,73 @@ class PopNode(bigtree.Node):
         self.name = name
         self.pop_name = None
 
+    def __setattr__(self, name, value):
+        # Frozen flowtrees are shared between threads without locks, so node attributes can not change
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError('Flowtree is frozen, "' + name + '" can not be set. Use unfreeze() to modify it.')
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError('Flowtree is frozen, "' + name + '" can not be deleted. Use unfreeze() to modify it.')
+        super().__delattr__(name)
+
+    def __getstate__(self):
+        # Locks can not be pickled or copied, and are created again when used
+        state = self.__dict__.copy()
+        state.pop('_lock', None)
+        return state
+
+    def get_lock(self):
+        """Returns the node lock, used to calculate lazily created node attributes (ie: 'counts') exactly once
+        when the flowtree is shared between threads. The lock is created on first use."""
+
+        lock = self.__dict__.get('_lock')
+        if lock is None:
+            # setdefault is atomic, so threads creating the lock at the same time all get the same lock
+            lock = self.__dict__.setdefault('_lock', threading.RLock())
+
+        return lock
+
+    def is_frozen(self):
+        """Returns True if the flowtree is frozen (see 'freeze')."""
+
+        return self.root.__dict__.get('_frozen', False)
+
+    def freeze(self):
+        """Calculates the counts of all nodes (and virtual nodes) in the flowtree, and makes all nodes read-only.
+        Frozen flowtrees can be queried from many threads at once without locks, since nothing is calculated
+        lazily. Use 'unfreeze' to modify the flowtree again.
+
+        Returns
+        ----------
+        root : object
+            The frozen flowtree root
+        """
+
+        root = self.root
+        if root.is_frozen():
+            return root
+
+        root.calculate_counts()
+        root.calculate_counts_tree()
+
+        # Align legacy 'mrti' data before the flowtree becomes read-only
+        root.get_sample_data()
+
+        for node in [root] + list(root.descendants):
+            object.__setattr__(node, '_frozen', True)
+
+        return root
+
+    def unfreeze(self):
+        """Makes the nodes of a frozen flowtree writable again (see 'freeze')."""
+
+        for node in [self.root] + list(self.root.descendants):
+            object.__setattr__(node, '_frozen', False)
+
+        return self.root
+
     def get_list_pop_names(self):
         """Returns list of 'pop_name' attribute for all nodes"""
 
@@ -72,6 +210,7 @@ class PopNode(bigtree.Node):
         """Prints flowtree structure with 'pop_name' attribute for all nodes"""
 
         new_self = self.copy()
+        new_self.unfreeze()
         new_self.name = new_self.pop_name
         for node in new_self.descendants:
             node.name = node.pop_name
@@ -88,32 +227,69 @@ class PopNode(bigtree.Node):
             print("The error is: ", err)
             raise RuntimeError('Population name was not found in PopTree.')
 
+    def find_path_or_popname(self, value):
+        """Finds node in flowtree by full path (if 'value' contains '/') or by 'pop_name' attribute."""
+
+        if '/' in value:
+            node = bigtree.find_full_path(self.root, value)
+        else:
+            node = self.find_popname(value)
+
+        if node is None:
+            raise RuntimeError('Population was not found in PopTree: ' + value)
+
+        return node
+
     def calculate_counts_tree(self):
         """Calculates event Counts on all descendants of self.
         Creates the 'counts' attribute for each descendent node of self."""
 
+        # Counts of frozen flowtrees are already calculated
+        if self.is_frozen():
+            return
+
+        # Counts add one DataFrame per node, the size of the flowtree root DataFrame with float64 'Data'
+        memory_budget = getattr(self.root, 'memory_budget', None)
+        if memory_budget is not None:
+            node_bytes = (self.root.freq_of_parent.drop(columns='Data').memory_usage(deep=True).sum()
+                          + 8 * len(self.root.freq_of_parent))
+            nbytes = len(list(self.descendants)) * node_bytes
+            check_memory_budget('Calculate counts', nbytes, memory_budget)
+
         for node in self.descendants:
+            if not isinstance(node, VirtualPopNode):
+                node.calculate_counts()
+
+        # Virtual nodes are calculated together (once, under the flowtree root lock), after their member nodes
+        for node in self.root.get_virtual_nodes():
             node.calculate_counts()
 
     def calculate_counts(self):
-        """Calculates event Counts on self by propagating freq_of_parent from flowtree 'Cells' node.
-        Creates the 'counts' attribute for self."""
+        """Calculates event Counts on self by propagating freq_of_parent from flowtree root node (ie: 'Cells').
+        Creates the 'counts' attribute for self. Counts are calculated and stored in float64 (sparse float64 in
+        masked mode), also when 'freq_of_parent' is float32 in memory-budget mode."""
 
         # print('Calculating counts for ' + self.pop_name + ':')
-        backgate_nodes = self.go_to(bigtree.find_name(self.root, 'Cells'))
+        backgate_nodes = self.go_to(self.root)
 
         # Starting at the highest ancestor of the population of interest:
         for node in reversed(backgate_nodes):
 
-            # If counts have not been calculated
-            if not hasattr(node, 'counts'):
+            # If counts have been calculated
+            if hasattr(node, 'counts'):
+                continue
+
+            # Counts are calculated once: threads waiting on the node lock use the counts calculated first
+            with node.get_lock():
+                if hasattr(node, 'counts'):
+                    continue
 
                 # If there is no parent - use flowtree root
                 if (node.parent is None) or node.is_root:
 
                     # Calculate counts from the Event Count column of mdh
                     # print('Calculating counts for backgate ' + node.path_name)
-                    counts = (node.freq_of_parent['Data'] * node.freq_of_parent['Event Count'].astype("float64")) / 100
+                    counts = propagate_counts(node.freq_of_parent['Data'], node.freq_of_parent['Event Count'])
                     data = node.freq_of_parent.copy().drop('Data', axis=1)
                     data['Data'] = counts
                     node.counts = data
@@ -129,7 +305,7 @@ class PopNode(bigtree.Node):
                     # print('Calculating counts for backgate ' + node.path_name)
                     merged_data = node.freq_of_parent.merge(node.parent.counts, on='FCS',
                                                             suffixes=('_freq', '_count'))
-                    counts = (merged_data['Data_freq'] * merged_data['Data_count']) / 100
+                    counts = propagate_counts(merged_data['Data_freq'], merged_data['Data_count'])
                     data = node.freq_of_parent.copy().drop('Data', axis=1)
                     data['Data'] = counts
                     node.counts = data
@@ -138,6 +314,152 @@ class PopNode(bigtree.Node):
                     if not (node.freq_of_parent.shape[0] == node.counts.shape[0]):
                         logging.warning('Number of samples for Freq of Parent and Counts are not consistent.')
 
+    def get_virtual_nodes(self):
+        """Returns list of VirtualPopNode nodes in the flowtree."""
+
+        return [node for node in self.root.descendants if isinstance(node, VirtualPopNode)]
+
+    def add_virtual_nodes(self, csv_virtual):
+        """
+        Adds virtual population nodes (sum or difference of the counts of existing nodes) to the flowtree.
+        Virtual nodes are added as children of their parent node.
+
+        Parameters
+        ----------
+        csv_virtual : str or object
+            Path of the virtual population CSV, or DataFrame. Each row has the virtual 'pop_name', the 'parent'
+            pop_name, the 'sign' ('+' or '-') and the 'member' pop_name to add or subtract (no header row, one row
+            per member)
+
+        Returns
+        ----------
+        virtual_nodes : list
+            The added VirtualPopNode nodes
+        """
+
+        if self.is_frozen():
+            raise AttributeError('Flowtree is frozen, virtual nodes can not be added. Use unfreeze() to modify it.')
+
+        if isinstance(csv_virtual, str):
+            spec = pd.read_csv(csv_virtual, names=['pop_name', 'parent', 'sign', 'member'])
+        else:
+            spec = csv_virtual
+
+        virtual_nodes = []
+        for pop_name, rows in spec.groupby('pop_name', sort=False):
+
+            parent_node = self.find_popname(rows['parent'].iloc[0])
+
+            members = []
+            for sign, member in zip(rows['sign'].str.strip(), rows['member']):
+                member_node = self.find_popname(member)
+
+                if sign not in ['+', '-']:
+                    raise ValueError('Virtual population sign must be "+" or "-": ' + pop_name)
+                if isinstance(member_node, VirtualPopNode):
+                    raise ValueError('Virtual population members must be flowtree gates: ' + member)
+                if member_node is not parent_node and parent_node not in member_node.ancestors:
+                    logging.warning(member + ' is not a descendant of ' + parent_node.pop_name)
+
+                members.append((sign, member))
+
+            node = VirtualPopNode(pop_name.replace('/', '_'), parent=parent_node)
+            node.pop_name = pop_name
+            node.members = members
+            if hasattr(parent_node, 'tissue'):
+                node.tissue = parent_node.tissue
+
+            virtual_nodes.append(node)
+
+        # Virtual counts are re-calculated for the new nodes
+        if hasattr(self.root, 'virtual_counts'):
+            del self.root.virtual_counts
+
+        return virtual_nodes
+
+    def calculate_virtual_counts(self):
+        """Calculates the counts of all virtual nodes in the flowtree in one pass, as the product of the member node
+        counts (samples x members) and the member signs (members x virtual nodes).
+        Creates the flowtree root 'virtual_counts' attribute (metadata columns and one column per virtual node)."""
+
+        virtual_nodes = self.get_virtual_nodes()
+        member_names = list(dict.fromkeys(member for node in virtual_nodes for _, member in node.members))
+
+        # Sign of each member node in each virtual node
+        coefficients = np.zeros((len(member_names), len(virtual_nodes)))
+        for j, node in enumerate(virtual_nodes):
+            for sign, member in node.members:
+                coefficients[member_names.index(member), j] += 1 if sign == '+' else -1
+
+        member_counts = np.column_stack([self.find_popname(member).get_data_array('counts')
+                                         for member in member_names])
+
+        # Missing member counts (ie: gates not in every batch) are missing in the virtual counts
+        missing = np.isnan(member_counts)
+        counts = np.nan_to_num(member_counts) @ coefficients
+        counts[(missing.astype('float64') @ (coefficients != 0)) > 0] = np.nan
+
+        df_counts = pd.DataFrame(counts, index=self.root.freq_of_parent.index,
+                                 columns=[node.pop_name for node in virtual_nodes])
+        self.root.virtual_counts = pd.concat([self.get_sample_metadata(), df_counts], axis=1)
+
+    def get_virtual_pop_names(self):
+        """Returns list of 'pop_name' attribute for all virtual nodes in the flowtree."""
+
+        return [node.pop_name for node in self.get_virtual_nodes()]
+
+    def is_descendant_of(self, node, subtracted=()):
+        """Returns True if the events of self are all in population 'node'. 'node' is an ancestor of self, or a
+        virtual node that includes self or an ancestor of self as a '+' member, and does not subtract self, an
+        ancestor of self or a descendant of self as a '-' member. A virtual self is a descendant of 'node' if all of
+        its '+' members are 'node' or descendants of 'node'. A node is never a descendant of itself.
+
+        Parameters
+        ----------
+        node : object
+            PopNode object, the possible ancestor population
+        subtracted : list
+            Optional. PopNode objects subtracted from self (the '-' members of a virtual node with self as a '+'
+            member). Populations of 'node' subtracted under self are allowed if they are in 'subtracted'
+
+        Returns
+        ----------
+        bool
+        """
+
+        if node is self:
+            return False
+
+        if isinstance(self, VirtualPopNode):
+            # Subtracted members only remove events, so only the '+' members have to be within 'node'
+            members = [(sign, self.root.find_path_or_popname(member)) for sign, member in self.members]
+            subtracted = list(subtracted) + [member for sign, member in members if sign == '-']
+            plus_nodes = [member for sign, member in members if sign == '+']
+
+            return bool(plus_nodes) and all(member is node or member.is_descendant_of(node, subtracted)
+                                            for member in plus_nodes)
+
+        if node in self.ancestors:
+            return True
+
+        if isinstance(node, VirtualPopNode):
+            lineage = [self.pop_name] + [x.pop_name for x in self.ancestors]
+
+            # Populations under a subtracted member are not part of the virtual population
+            if any(sign == '-' and member in lineage for sign, member in node.members):
+                return False
+
+            # Neither are populations with a subtracted member under them, unless it is also subtracted from self
+            for sign, member in node.members:
+                member_node = self.root.find_path_or_popname(member)
+                if sign == '-' and self in member_node.ancestors and \
+                        not any(x is member_node or x in member_node.ancestors for x in subtracted):
+                    return False
+
+            return any(sign == '+' and member in lineage for sign, member in node.members)
+
+        return False
+
     def get_freq_of_ancestor(self, ancestor, child=None):
         """Calculates population frequency of a specified ancestor.
         Specify alternate population node with optional 'child' input.
@@ -194,6 +516,10 @@ class PopNode(bigtree.Node):
             # raise Exception('Node missing "Count" attribute: ' + node.name)
             child_node.calculate_counts()
 
+        # If counts have not been calculated for ancestor node (ie: a virtual node), calculate counts
+        if not hasattr(ancestor_node, 'counts'):
+            ancestor_node.calculate_counts()
+
         # Initialize dataframe to hold counts of ancestor populations
         pop_counts = ancestor_node.counts
         merge_on = pop_counts.drop(columns='Data').columns.to_list()
@@ -201,8 +527,8 @@ class PopNode(bigtree.Node):
         # Merge Counts data from both child and ancestor nodes
         pop_counts = pop_counts.merge(child_node.counts, on=merge_on, suffixes=['_Anc', '_Des'], validate='one_to_one')
 
-        # Calculate the child population frequency of ancestor
-        pop_counts['Data'] = 100*(pop_counts['Data_Des']/pop_counts['Data_Anc'])
+        # Calculate the child population frequency of ancestor (in float64)
+        pop_counts['Data'] = 100*(pop_counts['Data_Des'].astype('float64')/pop_counts['Data_Anc'].astype('float64'))
 
         # Drop the count columns
         freq = pop_counts.drop(columns=['Data_Des', 'Data_Anc'])
@@ -260,16 +586,150 @@ class PopNode(bigtree.Node):
 
         return count, stat_name, stat_name_pop
 
+    def get_sample_metadata(self):
+        """Returns the metadata columns of the flowtree samples (flowtree root 'freq_of_parent' without 'Data')."""
+
+        return self.root.freq_of_parent.drop(columns='Data')
+
+    def get_data_array(self, attr_name='counts'):
+        """Returns the 'Data' column of a node DataFrame attribute ('counts' or 'freq_of_parent') as a float64 array,
+        with rows in the order of the flowtree samples. Creates the 'counts' attribute if it does not exist."""
+
+        if attr_name == 'counts' and not hasattr(self, 'counts'):
+            self.calculate_counts()
+
+        data = getattr(self, attr_name)['Data']
+
+        # Node DataFrames share the row index of the flowtree samples
+        sample_index = self.root.freq_of_parent.index
+        if not data.index.equals(sample_index):
+            data = data.reindex(sample_index)
+
+        return data.to_numpy(dtype='float64')
+
+    def append_sample_data(self, df_sample, name, on_column="SampleID"):
+        """Aligns an external per-sample DataFrame (ie: MRTI, MSOT) with the flowtree samples on 'on_column'.
+        Row positions are matched once and the aligned DataFrame is saved to the flowtree root 'sample_data'
+        attribute, so exports can gather its columns without merging.
+
+        Parameters
+        ----------
+        df_sample : object
+            DataFrame with one row per sample
+        name : str
+            Key of the aligned DataFrame in the flowtree root 'sample_data' attribute (ie: 'mrti')
+        on_column : str
+            Column to align the samples on. Default is "SampleID" to align on the individual samples
+            in the flowtree DataFrames
+
+        Returns
+        ----------
+        df_aligned : object
+            DataFrame of 'df_sample' columns, with rows in the order of the flowtree samples
+        """
+
+        if self.is_frozen():
+            raise AttributeError('Flowtree is frozen, sample data can not be added. Use unfreeze() to modify it.')
+
+        df_aligned = self.align_sample_data(df_sample, name, on_column)
+
+        with self.root.get_lock():
+            sample_data = dict(self.get_sample_data())
+            sample_data[name] = df_aligned
+            self.root.sample_data = sample_data
+
+        return df_aligned
+
+    def align_sample_data(self, df_sample, name, on_column="SampleID"):
+        """Returns the 'df_sample' columns with rows in the order of the flowtree samples, without saving them to
+        the flowtree root (see 'append_sample_data')."""
+
+        df_root = self.root.freq_of_parent
+
+        # Keep the first row of any duplicated sample
+        duplicated = df_sample[on_column].duplicated()
+        if duplicated.any():
+            logging.warning(name + ' data has duplicate ' + on_column + ' rows. Only the first row is kept.')
+            df_sample = df_sample[~duplicated]
+
+        # Flowtree metadata columns are not duplicated
+        drop_columns = [col for col in df_sample.columns if col in df_root.columns and col != on_column]
+        df_sample = df_sample.drop(columns=drop_columns)
+
+        # Keys of different types never match (ie: int64 SampleID and str SampleID), as in pandas.merge
+        key_dtypes = [x.dtype.categories.dtype if isinstance(x.dtype, pd.CategoricalDtype) else x.dtype
+                      for x in [df_root[on_column], df_sample[on_column]]]
+        if pd.api.types.is_numeric_dtype(key_dtypes[0]) != pd.api.types.is_numeric_dtype(key_dtypes[1]):
+            raise ValueError(name + ' data can not be aligned on ' + on_column + ': the flowtree column is ' +
+                             str(key_dtypes[0]) + ' and the ' + name + ' column is ' + str(key_dtypes[1]) + '.')
+
+        # Match the row positions of df_sample with the flowtree samples
+        df_aligned = df_sample.set_index(on_column).reindex(df_root[on_column])
+        df_aligned.index = df_root.index
+
+        if not df_root[on_column].isin(df_sample[on_column]).any():
+            raise ValueError('No ' + on_column + ' values of the ' + name + ' data match the flowtree samples.')
+
+        if df_aligned.isna().all(axis=1).any():
+            logging.warning(name + ' data is missing for some samples in the flowtree.')
+
+        return df_aligned
+
+    def get_sample_data(self):
+        """Returns the flowtree root 'sample_data' attribute. Flowtrees with only an 'mrti' attribute
+        (created before 'append_sample_data') are aligned on first use."""
+
+        if not hasattr(self.root, 'sample_data'):
+            with self.root.get_lock():
+                if not hasattr(self.root, 'sample_data'):
+                    sample_data = {}
+                    if hasattr(self.root, 'mrti'):
+                        sample_data['mrti'] = self.align_sample_data(self.root.mrti, 'mrti')
+
+                    # Saved once aligned, so other threads never read a partial 'sample_data'
+                    self.root.sample_data = sample_data
+
+        return self.root.sample_data
+
+    def join_sample_data(self, df, names=None):
+        """Gathers the aligned 'sample_data' columns for the rows of a flowtree DataFrame.
+        Columns are inserted after the metadata columns and before the 'Data' column, if there is one.
+
+        Parameters
+        ----------
+        df : object
+            DataFrame of a flowtree node attribute (ie: 'counts', 'freq_of_parent')
+        names : list[str]
+            Keys of the 'sample_data' DataFrames to include. Default includes all 'sample_data'
+
+        Returns
+        ----------
+        df_out : object
+            DataFrame with 'sample_data' columns
+        """
+
+        sample_data = self.get_sample_data()
+        if names is None:
+            names = list(sample_data)
+
+        # Gather rows by the flowtree sample index, which is shared by all node DataFrames
+        gathered = [sample_data[name].reindex(df.index) for name in names]
+
+        data_columns = [col for col in df.columns if col == 'Data']
+        df_out = pd.concat([df.drop(columns=data_columns)] + gathered + [df[data_columns]], axis=1)
+
+        return df_out
+
     def append_mrti_data(self, df_mrti, on_column="SampleID"):
-        """Merges MRTI dataframe with flowtree root dataframes on 'SampleID' column.
-        Creates flowtree root node 'mrti' attribute.
+        """Aligns MRTI dataframe with flowtree root dataframes on 'SampleID' column.
+        Adds 'mrti' to the flowtree root 'sample_data' attribute, and creates flowtree root node 'mrti' attribute.
 
         Parameters
         ----------
         df_mrti : object
             DataFrame containing MRTI statistics
         on_column : str
-            Column to perform DataFrame outer merge on. Default is "SampleID" to merge on
+            Column to align the DataFrames on. Default is "SampleID" to align on
             the individual samples in the flowtree DataFrames
 
         Returns
@@ -278,79 +738,132 @@ class PopNode(bigtree.Node):
             DataFrame of MRTI statistics merged with flowtree DataFrames
         """
 
-        df_root = self.root.freq_of_parent.copy()
-        df_root.drop('Data', axis=1, inplace=True)
-        df_root_new = pd.merge(df_root, df_mrti, on=on_column, how='outer')
-        df_root_new = df_root_new[~df_root_new['FCS'].isna()]
-
-        # check that df_root is the same size as before merge
-        if not len(df_root) == len(df_root_new):
-            logging.warning('MRTI Merge error: number of FCS files in dataset has changed.')
+        df_root = self.root.freq_of_parent.drop('Data', axis=1)
+        df_aligned = self.append_sample_data(df_mrti, 'mrti', on_column=on_column)
+        df_root_new = pd.concat([df_root, df_aligned], axis=1)
 
         self.root.mrti = df_root_new
 
-        return df_root_new  # was df_root. changed 4/5/2024. Check if correct.
+        return df_root_new
 
-    def export_tree_as_dataframe(self, to_csv=True, csv_filename='tree_data', merge_mrti=True):
+    def get_feature_matrix(self, stat='freq_of_parent', populations=None, index_cols=('FCS', 'SampleID'),
+                           dropna=True):
         """
-        Export flowtree 'counts' and 'freq_of_parent' attributes to DataFrame and/or CSV.
-        Option to include 'mrti' attribute as well.
+        Builds a samples x populations matrix of one statistic, for sample similarity and clustering.
 
         Parameters
         ----------
-        to_csv : bool
-            if True, export DataFrame to csv.
-        csv_filename : str
-            Pre-fix for exported CSV filename
+        stat : str
+            'freq_of_parent', 'counts', or the 'pop_name' of an ancestor population to calculate the frequency of
+            (ie: 'Live')
+        populations : list[str]
+            Optional. 'pop_name' attributes of the populations (columns). Default is all descendants of self, or
+            of the ancestor population
+        index_cols : tuple[str]
+            Metadata columns used as the row index
+        dropna : bool
+            if True, drop populations with missing values for any sample
+
+        Returns
+        ----------
+        df_features : object
+            DataFrame with one row per sample and one column per population 'pop_name'
+        """
+
+        ancestor_node = None
+        if stat not in ['freq_of_parent', 'counts']:
+            ancestor_node = self.find_popname(stat)
+
+        if populations:
+            nodes = [self.find_popname(pop) for pop in populations]
+        elif isinstance(ancestor_node, VirtualPopNode):
+            # Virtual populations have no child nodes, their member populations are under their parent
+            nodes = [node for node in ancestor_node.parent.descendants if node.is_descendant_of(ancestor_node)]
+        elif ancestor_node is not None:
+            nodes = list(ancestor_node.descendants)
+        else:
+            nodes = list(self.descendants)
+
+        if ancestor_node is not None:
+            # check that ancestor is an ancestor of each node
+            not_descendants = [node.pop_name for node in nodes if not node.is_descendant_of(ancestor_node)]
+            if not_descendants:
+                logging.warning(stat + ' is not an ancestor of ' + ', '.join(not_descendants))
+                nodes = [node for node in nodes if node.pop_name not in not_descendants]
+
+            if not nodes:
+                raise ValueError('No populations to calculate the frequency of ' + stat + ' for.')
+
+            counts = np.column_stack([node.get_data_array('counts') for node in nodes])
+            features = 100 * counts / ancestor_node.get_data_array('counts')[:, None]
+
+        else:
+            features = np.column_stack([node.get_data_array(stat) for node in nodes])
+
+        index = pd.MultiIndex.from_frame(self.get_sample_metadata()[list(index_cols)].astype('str'))
+        df_features = pd.DataFrame(features, index=index, columns=[node.pop_name for node in nodes])
+
+        if dropna:
+            nan_columns = df_features.columns[df_features.isna().any()].to_list()
+            if nan_columns:
+                logging.warning('Populations with missing values were dropped: ' + ', '.join(nan_columns))
+                df_features = df_features.drop(columns=nan_columns)
+
+        return df_features
+
+    def evaluate_expressions(self, expressions, merge_mrti=False):
+        """
+        Evaluates derived metrics over flowtree populations in one batch, ie: CD8/CD4 ratio.
+        Expressions are compiled once (and cached) into vectorized operations over the population arrays.
+
+        Parameters
+        ----------
+        expressions : list[str] or dict
+            Expressions using count('<pop_name or path>') and freq('<pop_name or path>'), ie:
+            "count('CD8+ T Cells') / count('CD4+ T Cells')". Or dict of column name: expression
         merge_mrti : bool
-            if True, include 'mrti' data from the flowtree in exported DataFrame/CSV file
+            if True, include 'sample_data' (ie: 'mrti') from the flowtree in the DataFrame
 
         Returns
         ----------
-        df_counts : object
-            DataFrame with merged 'counts' attribute for all nodes in the flowtree
-        df_freq : object
-            DataFrame with merged 'freq_of_parent' attribute for all nodes in the flowtree.
+        df_out : object
+            DataFrame of sample metadata, with one column per expression
         """
 
-        # Export Freq of Parent
-        df_out = self.freq_of_parent.copy()
-        merge_on = df_out.drop(columns='Data').columns.to_list()
+        df_out = expression_tools.evaluate_expressions(self.root, expressions)
 
         if merge_mrti:
-            df_out = pd.merge(self.root.mrti, df_out, on=merge_on, validate='one_to_one')
+            df_out = self.join_sample_data(df_out)
 
-        # root node exported data
-        df_out.rename(columns={'Data': self.pop_name + ' | Freq of Parent (%)'}, inplace=True)
+        return df_out
 
-        # root descendant nodes exported data
-        header_fullpath = df_out.columns.to_list()
-        for node in self.descendants:
-            df = node.freq_of_parent.copy()
-            header_fullpath.append(node.path_name + ' | Freq of Parent (%)')
-            df.rename(columns={'Data': node.pop_name + ' | Freq of Parent (%)'}, inplace=True)
-            df_out = pd.merge(df_out, df, on=merge_on, validate='one_to_one')
+    def assemble_tree_frame(self, attr_name='freq_of_parent', merge_mrti=True):
+        """
+        Merges a DataFrame attribute ('freq_of_parent' or 'counts') of all nodes in the flowtree into one DataFrame.
+        Used by all export formats.
 
-        # export to csv
-        if to_csv:
-            if not len(df_out.columns.to_list()) == len(header_fullpath):
-                logging.warning('Export to CSV error: Header column list does not match DataFrame header columns.')
+        Parameters
+        ----------
+        attr_name : str
+            'freq_of_parent' or 'counts'
+        merge_mrti : bool
+            if True, include 'sample_data' (ie: 'mrti') from the flowtree in the DataFrame
 
-            with open(csv_filename + '_Freq_of_Parent.csv', 'w') as f:
-                # f.write('\n'.join([','.join(line) for line in header]) + '\n')
-                writer = csv.writer(f)
-                writer.writerow(header_fullpath)
-                df_out.to_csv(f, index=False, header=True)
+        Returns
+        ----------
+        df_out : object
+            DataFrame with merged attribute for all nodes in the flowtree (in float64)
+        header_fullpath : list
+            Column names in df_out, using the full pathnames of each node
+        """
 
-        df_freq = df_out.copy()
-        del df_out
+        stat = ' | Count' if attr_name == 'counts' else ' | Freq of Parent (%)'
 
-        # Export Counts
-        df_out = self.counts.copy()
+        df_out = getattr(self, attr_name).astype({'Data': 'float64'})
         merge_on = df_out.drop(columns='Data').columns.to_list()
 
         if merge_mrti:
-            df_out = pd.merge(self.root.mrti, df_out, on=merge_on, validate='one_to_one')
+            df_out = self.join_sample_data(df_out)
 
         # root node exported data
         df_out.rename(columns={'Data': self.pop_name + ' | Freq of Parent (%)'}, inplace=True)
@@ -358,48 +871,64 @@ class PopNode(bigtree.Node):
         # root descendant nodes exported data
         header_fullpath = df_out.columns.to_list()
         for node in self.descendants:
-            df = node.counts.copy()
-            header_fullpath.append(node.path_name + ' | Count')
-            df.rename(columns={'Data': node.pop_name + ' | Count'}, inplace=True)
+            df = getattr(node, attr_name).astype({'Data': 'float64'})
+            header_fullpath.append(node.path_name + stat)
+            df.rename(columns={'Data': node.pop_name + stat}, inplace=True)
             df_out = pd.merge(df_out, df, on=merge_on, validate='one_to_one')
 
-        # export to csv
-        if to_csv:
-            if not len(df_out.columns.to_list()) == len(header_fullpath):
-                logging.warning('Export to CSV error: Header column list does not match DataFrame header columns.')
-
-            with open(csv_filename + '_Counts.csv', 'w') as f:
-                # f.write('\n'.join([','.join(line) for line in header]) + '\n')
-                writer = csv.writer(f)
-                writer.writerow(header_fullpath)
-                df_out.to_csv(f, index=False, header=True)
-
-        df_counts = df_out.copy()
-
-        return df_counts, df_freq
+        return df_out, header_fullpath
 
-    def export_freqs_as_dataframe(self, sub_populations, populations,
-                                  to_csv=True, csv_filename='tree_data',
-                                  merge_mrti=True, freq_of_parent=True):
+    def export_tree_as_dataframe(self, to_csv=True, csv_filename='tree_data', merge_mrti=True,
+                                 file_format='csv', partition_cols=None, compression=None):
         """
-        Export custom population frequency data from the flowtree to CSV.
+        Export flowtree 'counts' and 'freq_of_parent' attributes to DataFrame and/or CSV, Parquet or Arrow files.
+        Option to include 'sample_data' attribute (ie: 'mrti') as well.
 
         Parameters
         ----------
-        sub_populations : list[str]
-            a list of strings, which are the population alias names (pop_name) for each "child" population to calculate
-            the frequencies of
-        populations : list[str]
-            a list of stings, which are the population alias names (pop_name) for each ancestor population that each
-            child frequency will be calculated from
         to_csv : bool
-            if True, export DataFrame to csv.
+            if True, export DataFrame to file (in 'file_format').
         csv_filename : str
-            Pre-fix for exported CSV filename
+            Pre-fix for exported filename
         merge_mrti : bool
-            if True, include 'mrti' data from the flowtree in exported DataFrame/CSV file
-        freq_of_parent : bool
-            if True, include the 'freq_of_parent' attribute for every node in 'sub_populations'
+            if True, include 'sample_data' (ie: 'mrti') from the flowtree in exported DataFrame/file
+        file_format : str
+            'csv', 'parquet' or 'arrow'. Parquet/Arrow store the full path names as column metadata
+        partition_cols : list[str]
+            Optional. Parquet/Arrow only. Metadata columns to partition the export by (ie: Treatment Group)
+        compression : str
+            Optional. Parquet/Arrow only. Compression codec
+
+        Returns
+        ----------
+        df_counts : object
+            DataFrame with merged 'counts' attribute for all nodes in the flowtree
+        df_freq : object
+            DataFrame with merged 'freq_of_parent' attribute for all nodes in the flowtree.
+        """
+
+        extension = export_tools.FILE_EXTENSIONS[file_format]
+
+        # Export Freq of Parent
+        df_freq, header_fullpath = self.assemble_tree_frame('freq_of_parent', merge_mrti)
+
+        if to_csv:
+            export_tools.export_dataframe(df_freq, csv_filename + '_Freq_of_Parent' + extension, header_fullpath,
+                                          file_format, partition_cols, compression)
+
+        # Export Counts
+        df_counts, header_fullpath = self.assemble_tree_frame('counts', merge_mrti)
+
+        if to_csv:
+            export_tools.export_dataframe(df_counts, csv_filename + '_Counts' + extension, header_fullpath,
+                                          file_format, partition_cols, compression)
+
+        return df_counts, df_freq
+
+    def assemble_freqs_frame(self, sub_populations, populations, merge_mrti=True, freq_of_parent=True):
+        """
+        Merges custom population frequency data from the flowtree into one DataFrame. Used by all export formats.
+        See 'export_freqs_as_dataframe' for parameters.
 
         Returns
         ----------
@@ -414,28 +943,18 @@ class PopNode(bigtree.Node):
         merge_on = df_out.columns.to_list()  # drop(columns='Data').columns.to_list()
 
         if merge_mrti:
-            df_out = pd.merge(self.root.mrti, df_out, on=merge_on, validate='one_to_one')
+            df_out = self.join_sample_data(df_out)
 
         header_fullpath = df_out.columns.to_list()
 
-        # if freq_of_parent:
-        #     for sub_pop in sub_populations:
-        #
-        #         sub_pop_node = bigtree.find_attr(self.root, 'pop_name', sub_pop)
-        #         df = sub_pop_node.freq_of_parent.copy()
-        #         header_fullpath.append(sub_pop_node.path_name + ' | Freq of Parent (%)')
-        #         df.rename(columns={'Data': sub_pop_node.pop_name + ' | Freq of Parent (%)'}, inplace=True)
-        #         df_out = pd.merge(df_out, df, on=merge_on, validate='one_to_one')
-
         for sub_pop in sub_populations:
 
             # pop_node = bigtree.find_attr(self.root, 'pop_name', pop)
-            sub_pop_node = bigtree.find_attr(self.root, 'pop_name', sub_pop)
+            sub_pop_node = self.find_path_or_popname(sub_pop)
 
             if freq_of_parent:
 
-                sub_pop_node = bigtree.find_attr(self.root, 'pop_name', sub_pop)
-                df = sub_pop_node.freq_of_parent.copy()
+                df = sub_pop_node.freq_of_parent.astype({'Data': 'float64'})
                 header_fullpath.append(sub_pop_node.path_name + ' | Freq of Parent (%)')
                 df.rename(columns={'Data': sub_pop_node.pop_name + ' | Freq of Parent (%)'}, inplace=True)
                 df_out = pd.merge(df_out, df, on=merge_on, validate='one_to_one')
@@ -443,7 +962,7 @@ class PopNode(bigtree.Node):
             for pop in populations:
 
                 # check that ancestor is an ancestor of child_node:
-                if pop not in [x.pop_name for x in sub_pop_node.ancestors]:
+                if not sub_pop_node.is_descendant_of(self.find_path_or_popname(pop)):
                     logging.warning(pop + ' is not an ancestor of ' + sub_pop)
                     continue
 
@@ -452,16 +971,52 @@ class PopNode(bigtree.Node):
                 df.rename(columns={'Data': stat_name_pop}, inplace=True)
                 df_out = pd.merge(df_out, df, on=merge_on, validate='one_to_one')
 
-        # export to csv
-        if to_csv:
-            if not len(df_out.columns.to_list()) == len(header_fullpath):
-                logging.warning('Export to CSV error: Header column list does not match DataFrame header columns.')
+        return df_out, header_fullpath
 
-            with open(csv_filename, 'w') as f:
-                # f.write('\n'.join([','.join(line) for line in header]) + '\n')
-                writer = csv.writer(f)
-                writer.writerow(header_fullpath)
-                df_out.to_csv(f, index=False, header=True)
+    def export_freqs_as_dataframe(self, sub_populations, populations,
+                                  to_csv=True, csv_filename='tree_data',
+                                  merge_mrti=True, freq_of_parent=True,
+                                  file_format='csv', partition_cols=None, compression=None):
+        """
+        Export custom population frequency data from the flowtree to CSV, Parquet or Arrow files.
+
+        Parameters
+        ----------
+        sub_populations : list[str]
+            a list of strings, which are the population alias names (pop_name) for each "child" population to calculate
+            the frequencies of
+        populations : list[str]
+            a list of stings, which are the population alias names (pop_name) for each ancestor population that each
+            child frequency will be calculated from
+        to_csv : bool
+            if True, export DataFrame to file (in 'file_format').
+        csv_filename : str
+            Exported filename
+        merge_mrti : bool
+            if True, include 'sample_data' (ie: 'mrti') from the flowtree in exported DataFrame/file
+        freq_of_parent : bool
+            if True, include the 'freq_of_parent' attribute for every node in 'sub_populations'
+        file_format : str
+            'csv', 'parquet' or 'arrow'. Parquet/Arrow store the full path names as column metadata
+        partition_cols : list[str]
+            Optional. Parquet/Arrow only. Metadata columns to partition the export by (ie: Treatment Group)
+        compression : str
+            Optional. Parquet/Arrow only. Compression codec
+
+        Returns
+        ----------
+        df_out : object
+            DataFrame of all merged data
+        header_fullpath : list
+            Column names in df_out, using the full pathnames of each frequency statistic.
+        """
+
+        df_out, header_fullpath = self.assemble_freqs_frame(sub_populations, populations,
+                                                            merge_mrti, freq_of_parent)
+
+        if to_csv:
+            export_tools.export_dataframe(df_out, csv_filename, header_fullpath,
+                                          file_format, partition_cols, compression)
 
         return df_out, header_fullpath
 
@@ -516,3 +1071,60 @@ class PopNode(bigtree.Node):
     #
     #
     #
+
+
+class VirtualPopNode(PopNode):
+    """
+    Population node defined as the sum or difference of the counts of existing nodes (ie: all memory T cell subsets).
+    Counts of all virtual nodes are stored together in the flowtree root 'virtual_counts' attribute, and the
+    'counts' and 'freq_of_parent' attributes are created from it when used.
+    """
+
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.members = []
+
+    @property
+    def counts(self):
+        """Metadata columns and 'Data' column of the virtual node counts."""
+
+        virtual_counts = getattr(self.root, 'virtual_counts', None)
+        if virtual_counts is None or self.pop_name not in virtual_counts.columns:
+            raise AttributeError('Virtual node counts have not been calculated: ' + self.pop_name)
+
+        metadata = [col for col in self.root.freq_of_parent.columns if col != 'Data']
+        return virtual_counts[metadata + [self.pop_name]].rename(columns={self.pop_name: 'Data'})
+
+    @property
+    def freq_of_parent(self):
+        """Metadata columns and 'Data' column of the virtual node frequency of parent (%)."""
+
+        data = self.get_sample_metadata()
+        data['Data'] = 100 * self.get_data_array('counts') / self.parent.get_data_array('counts')
+
+        return data
+
+    def calculate_counts(self):
+        """Calculates the counts of all virtual nodes in the flowtree (once, under the flowtree root lock)."""
+
+        if not hasattr(self, 'counts'):
+            with self.root.get_lock():
+                if not hasattr(self, 'counts'):
+                    self.root.calculate_virtual_counts()
+
+    def get_data_array(self, attr_name='counts'):
+        """Returns the virtual node counts or freq_of_parent as a float64 array, with rows in the order of the
+        flowtree samples."""
+
+        if attr_name != 'counts':
+            return self.freq_of_parent['Data'].to_numpy(dtype='float64')
+
+        if not hasattr(self, 'counts'):
+            self.calculate_counts()
+
+        data = self.root.virtual_counts[self.pop_name]
+        sample_index = self.root.freq_of_parent.index
+        if not data.index.equals(sample_index):
+            data = data.reindex(sample_index)
+
+        return data.to_numpy(dtype='float64')
@@ -0,0 +1,350 @@
+import argparse
+import http.server
+import io
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+import urllib.parse
+import export_tools
+import lazy_imports
+
+pd = lazy_imports.lazy_import('pandas')
+
+# Query parameters each endpoint requires
+REQUIRED_PARAMS = {'freqs': [], 'freq_of_ancestor': ['child', 'ancestor'], 'summary': []}
+
+# Endpoints reported in the service metrics. Requests to other paths are reported as 'unknown'
+ENDPOINTS = list(REQUIRED_PARAMS) + ['trees', 'metrics']
+
+
+class FlowtreeService:
+    """
+    Keeps flowtrees loaded in memory and answers export queries on them.
+    Flowtree pickle files are reloaded when they change on disk.
+
+    Parameters
+    ----------
+    tree_files : dict
+        dict of tree name: path of the pickled flowtree (ie: {'tumor': 'tumor_tree_master.pkl'})
+    """
+
+    def __init__(self, tree_files):
+        self.tree_files = tree_files
+        self.trees = {}
+        self.mtimes = {}
+        self.tree_locks = {name: threading.Lock() for name in tree_files}
+        self.latencies = {}
+        self.errors = {}
+        self.metrics_lock = threading.Lock()
+
+        for name in tree_files:
+            self.get_tree(name)
+
+    def get_tree(self, name):
+        """Returns the loaded flowtree 'name', reloading it first if its pickle file has changed.
+        If the pickle file can not be loaded (ie: it is deleted, or still being written), the flowtree that is
+        already loaded is returned."""
+
+        if name not in self.tree_files:
+            raise KeyError('Flowtree was not found: ' + name)
+
+        try:
+            mtime = os.path.getmtime(self.tree_files[name])
+            if self.mtimes.get(name) != mtime:
+                with self.tree_locks[name]:
+                    if self.mtimes.get(name) != mtime:
+                        print('Loading flowtree ' + name + ' from ' + self.tree_files[name])
+                        with open(self.tree_files[name], 'rb') as f:
+                            root = pickle.load(f)
+
+                        # Frozen flowtrees are calculated once, and queried by all request threads without locks
+                        self.trees[name] = root.freeze()
+                        self.mtimes[name] = mtime
+
+        except Exception as err:
+            if name not in self.trees:
+                raise
+
+            # The modification time is not saved, so the pickle file is loaded again on the next query
+            logging.warning('Flowtree ' + name + ' could not be reloaded, using the loaded flowtree: ' + repr(err))
+
+        return self.trees[name]
+
+    def query(self, endpoint, name, params):
+        """
+        Runs a query on the flowtree 'name'.
+
+        Parameters
+        ----------
+        endpoint : str
+            'freqs', 'freq_of_ancestor' or 'summary'
+        name : str
+            Name of the flowtree
+        params : dict
+            dict of query parameter: list of values
+
+        Returns
+        ----------
+        df_out : object
+            DataFrame of query results
+        header_fullpath : list
+            Column names in df_out, using the full pathnames of each statistic
+        """
+
+        if endpoint not in REQUIRED_PARAMS:
+            raise KeyError('Unknown endpoint: ' + endpoint)
+
+        root = self.get_tree(name)
+
+        missing = [key for key in REQUIRED_PARAMS[endpoint] if not params.get(key)]
+        if missing:
+            raise ValueError('Missing query parameters for ' + endpoint + ': ' + ', '.join(missing))
+
+        # Population names are resolved first, so unknown names raise a RuntimeError
+        for key in ['sub_pop', 'pop', 'child', 'ancestor']:
+            for population in params.get(key, []):
+                root.find_path_or_popname(population)
+
+        if endpoint == 'freqs':
+            df_out, header_fullpath = root.export_freqs_as_dataframe(
+                params.get('sub_pop', []), params.get('pop', []), to_csv=False,
+                merge_mrti=get_bool(params, 'merge_mrti', True),
+                freq_of_parent=get_bool(params, 'freq_of_parent', True))
+
+        elif endpoint == 'freq_of_ancestor':
+            child_node = root.find_path_or_popname(params['child'][0])
+            df_out, stat_name, stat_name_pop = child_node.get_freq_of_ancestor(params['ancestor'][0])
+            df_out = df_out.rename(columns={'Data': stat_name_pop})
+            header_fullpath = df_out.columns.to_list()[:-1] + [stat_name]
+
+        else:
+            df_out = summarize_tree(root)
+            header_fullpath = df_out.columns.to_list()
+
+        # Filter rows of the results by a metadata column (the flowtree is not modified)
+        if 'filter_column' in params:
+            if params['filter_column'][0] not in df_out.columns:
+                raise ValueError('Filter column was not found: ' + params['filter_column'][0])
+            df_out = filter_rows(df_out, params['filter_column'][0], params.get('keep'), params.get('drop'))
+
+        return df_out, header_fullpath
+
+    def record_latency(self, endpoint, seconds, error=False):
+        """Adds a request latency to the service metrics. Failed requests are also counted as errors."""
+
+        if endpoint not in ENDPOINTS:
+            endpoint = 'unknown'
+
+        with self.metrics_lock:
+            self.latencies.setdefault(endpoint, []).append(seconds * 1000)
+            if error:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def get_metrics(self):
+        """Returns request count, error count and latency statistics (ms) for each endpoint."""
+
+        with self.metrics_lock:
+            latencies = {endpoint: list(values) for endpoint, values in self.latencies.items()}
+            errors = dict(self.errors)
+
+        metrics = {}
+        for endpoint, values in latencies.items():
+            values = pd.Series(values)
+            metrics[endpoint] = {'requests': len(values),
+                                 'errors': errors.get(endpoint, 0),
+                                 'mean_ms': values.mean(),
+                                 'p50_ms': values.quantile(0.5),
+                                 'p95_ms': values.quantile(0.95),
+                                 'max_ms': values.max()}
+
+        return metrics
+
+
+def get_bool(params, key, default):
+    """Returns a boolean query parameter."""
+
+    if key not in params:
+        return default
+
+    return params[key][0].lower() in ['1', 'true', 'yes']
+
+
+def filter_rows(df, var_column, keep_values=None, drop_values=None):
+    """Filters rows of a DataFrame by values of a metadata column, as 'filter_node' does for flowtree nodes."""
+
+    if keep_values:
+        df = df.loc[df[var_column].astype('str').isin(keep_values)]
+
+    if drop_values:
+        df = df.loc[~df[var_column].astype('str').isin(drop_values)]
+
+    return df
+
+
+def summarize_tree(root):
+    """
+    Summarizes each node of a flowtree.
+
+    Returns
+    ----------
+    df_summary : object
+        DataFrame with 'pop_name', 'path_name', 'samples', 'mean_freq_of_parent' and 'mean_count' columns
+    """
+
+    rows = []
+    for node in [root] + list(root.descendants):
+        count, _, _ = node.get_count()
+        rows.append({'pop_name': node.pop_name,
+                     'path_name': node.path_name,
+                     'samples': len(node.freq_of_parent),
+                     'mean_freq_of_parent': node.freq_of_parent['Data'].astype('float64').mean(),
+                     'mean_count': count['Data'].astype('float64').mean()})
+
+    return pd.DataFrame(rows)
+
+
+def to_payload(df_out, header_fullpath, file_format='csv'):
+    """
+    Serializes query results.
+
+    Parameters
+    ----------
+    df_out : object
+        DataFrame of query results
+    header_fullpath : list
+        Column names in df_out, using the full pathnames of each statistic. Written as the first CSV row
+        (if different from the df_out column names), or stored as Parquet/Arrow column metadata
+    file_format : str
+        'csv', 'parquet' or 'arrow'
+
+    Returns
+    ----------
+    payload : bytes
+    content_type : str
+    """
+
+    if file_format == 'csv':
+        f = io.StringIO()
+        if header_fullpath == df_out.columns.to_list():
+            header_fullpath = None
+        export_tools.write_csv(df_out, f, header_fullpath)
+        return f.getvalue().encode(), 'text/csv'
+
+    elif file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        f = io.BytesIO()
+        pq.write_table(export_tools.dataframe_to_arrow(df_out, header_fullpath), f)
+        return f.getvalue(), 'application/vnd.apache.parquet'
+
+    elif file_format == 'arrow':
+        table = export_tools.dataframe_to_arrow(df_out, header_fullpath)
+        sink = export_tools.pa.BufferOutputStream()
+        with export_tools.pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), 'application/vnd.apache.arrow.stream'
+
+    raise ValueError('Unknown format: ' + file_format)
+
+
+class FlowtreeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves FlowtreeService queries over HTTP GET:
+
+    /trees
+    /metrics
+    /freqs/<tree>?sub_pop=...&sub_pop=...&pop=...&merge_mrti=true&freq_of_parent=true
+    /freq_of_ancestor/<tree>?child=...&ancestor=...
+    /summary/<tree>
+
+    Query endpoints accept 'format' (csv, parquet, arrow), and 'filter_column' with 'keep' or 'drop' values.
+    """
+
+    service = None
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urllib.parse.urlparse(self.path)
+        parts = [urllib.parse.unquote(x) for x in url.path.strip('/').split('/')]
+        params = urllib.parse.parse_qs(url.query)
+        endpoint = parts[0]
+
+        try:
+            if endpoint == 'trees':
+                body = json.dumps({name: self.service.tree_files[name] for name in self.service.trees})
+                payload, content_type = body.encode(), 'application/json'
+
+            elif endpoint == 'metrics':
+                payload, content_type = json.dumps(self.service.get_metrics()).encode(), 'application/json'
+
+            elif len(parts) == 2:
+                df_out, header_fullpath = self.service.query(endpoint, parts[1], params)
+                file_format = params.get('format', ['csv'])[0]
+                payload, content_type = to_payload(df_out, header_fullpath, file_format)
+
+            else:
+                raise KeyError('Unknown endpoint: ' + url.path)
+
+        except (KeyError, ValueError, RuntimeError) as err:
+            self.service.record_latency(endpoint, time.perf_counter() - start, error=True)
+            self.send_error(404 if isinstance(err, KeyError) else 400, str(err))
+            return
+
+        except Exception as err:
+            logging.exception('Query failed: ' + self.path)
+            self.service.record_latency(endpoint, time.perf_counter() - start, error=True)
+            self.send_error(500, repr(err))
+            return
+
+        latency = time.perf_counter() - start
+        self.service.record_latency(endpoint, latency)
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Server-Timing', 'query;dur=' + str(round(latency * 1000, 2)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+def serve(tree_files, host='127.0.0.1', port=8765):
+    """
+    Loads flowtrees once and serves queries on them until interrupted.
+
+    Parameters
+    ----------
+    tree_files : dict
+        dict of tree name: path of the pickled flowtree
+    host : str
+        Address to serve on. Default is localhost only
+    port : int
+        Port to serve on
+    """
+
+    handler = type('Handler', (FlowtreeRequestHandler,), {'service': FlowtreeService(tree_files)})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    print('Serving flowtrees ' + ', '.join(tree_files) + ' on http://' + host + ':' + str(port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve flowtree queries from flowtrees kept in memory.')
+    parser.add_argument('trees', nargs='+', help='name=path of a pickled flowtree (ie: tumor=tumor_tree_master.pkl)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    serve(dict(x.split('=', 1) for x in args.trees), host=args.host, port=args.port)
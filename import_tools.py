@@ -1,15 +1,22 @@
 # This is a sample Python script.
 import logging
-import bigtree
+import lazy_imports
 import flowtree
+import export_tools
+import bigtree
 import os
 import csv
-import pandas as pd
 
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+
+# Metadata column that identifies the batch (panel) of each sample, for masked storage
+BATCH_COLUMN = 'Treatment Batch'
 
-def load_csvs_to_dataframe(local_dir, search_string=None, exclude_files=None):
+
+def list_csv_files(local_dir, search_string=None, exclude_files=None):
     """
-    Loads CSV files in directory and concatenates into a DataFrame.
+    Lists CSV files in directory.
 
     Parameters
     ----------
@@ -22,8 +29,8 @@ def load_csvs_to_dataframe(local_dir, search_string=None, exclude_files=None):
 
     Returns
     -------
-    DataFrame
-        the DataFrame of all concatenated CSV data
+    files : list[string]
+        CSV filenames in local_dir
 
     """
 
@@ -31,19 +38,215 @@ def load_csvs_to_dataframe(local_dir, search_string=None, exclude_files=None):
     files = os.listdir(local_dir)
 
     # Remove excluded_files from list
-    files = [x for x in files if x not in exclude_files]
+    if exclude_files:
+        files = [x for x in files if x not in exclude_files]
 
     # Keep files that contain the search_string
     if search_string:
         files = [x for x in files if search_string in x]
 
+    return files
+
+
+def read_csv_header(filename):
+    """
+    Reads only the header line of a CSV file. Empty and duplicate column names are named as pandas names them
+    ('Unnamed: 0', 'X.1').
+
+    Parameters
+    ----------
+    filename : string
+        absolute path to CSV file.
+
+    Returns
+    -------
+    header : list[string]
+        column names of the CSV file
+
+    """
+
+    # 'utf-8-sig' removes the byte order mark of CSV files saved by Excel, as pandas does
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f), [])
+
+    unnamed = [i for i, col in enumerate(header) if not col]
+    header = [col if col else 'Unnamed: ' + str(i) for i, col in enumerate(header)]
+
+    # Duplicate column names are followed by '.1', '.2', ... skipping names already in the header. Named columns
+    # are renamed before unnamed columns, as in pandas.read_csv
+    counts = {}
+    for i in [i for i in range(len(header)) if i not in unnamed] + unnamed:
+        col = header[i]
+        count = counts.get(col, 0)
+        while count > 0:
+            counts[header[i]] = count + 1
+            col = header[i] + '.' + str(count)
+            count = count + 1 if col in header else counts.get(col, 0)
+        header[i] = col
+        counts[col] = count + 1
+
+    return header
+
+
+def load_pop_names(csv_popnames):
+    """
+    Loads the MASTER population names CSV (pop_name, full path column name) into a DataFrame.
+    'csv_popnames' can also be a DataFrame with 'pop_name' and 'PATH_NAME_XREF' columns (ie: from
+    'wsp_tools.make_pop_names').
+    """
+
+    if isinstance(csv_popnames, pd.DataFrame):
+        return csv_popnames[['pop_name', 'PATH_NAME_XREF']]
+
+    return pd.read_csv(csv_popnames, names=['pop_name', 'PATH_NAME_XREF'])
+
+
+def prescan_csv_headers(local_dir, search_string=None, exclude_files=None, csv_popnames=None):
+    """
+    Compares the column headers of CSV files before loading them. Only the header line of each file is read.
+    Reports columns that are not in every file, and population columns that are not in the MASTER
+    population names CSV (used by 'create_pop_tree').
+
+    Parameters
+    ----------
+    local_dir : string
+        absolute path to CSV data on local machine.
+    search_string : string
+        includes all CSV filenames with this string.
+    exclude_files : list[string]
+        excludes filenames in list.
+    csv_popnames : string
+        Optional. Path of the MASTER population names CSV, or a DataFrame (see 'load_pop_names').
+
+    Returns
+    -------
+    schema : dict
+        'files' (dict of file: column list), 'union' and 'intersection' (sets of columns),
+        'missing' (dict of file: set of union columns missing from file), 'unnamed' (set of population columns
+        missing from the population names CSV), 'not_found' (set of population names CSV columns missing from all
+        files), and 'report' (DataFrame of mismatched columns, one bool column per file)
+
+    """
+
+    files = list_csv_files(local_dir, search_string, exclude_files)
+    headers = {file: read_csv_header(local_dir + file) for file in files}
+
+    # Union and intersection of the column headers
+    header_sets = [set(header) for header in headers.values()]
+    union = set().union(*header_sets)
+    intersection = set.intersection(*header_sets) if header_sets else set()
+    missing = {file: union - set(header) for file, header in headers.items()}
+
+    # Compare population columns with the MASTER population names
+    unnamed = set()
+    not_found = set()
+    pop_names = {}
+    if csv_popnames is not None:
+        names_xref = load_pop_names(csv_popnames)
+        pop_names = dict(zip(names_xref['PATH_NAME_XREF'], names_xref['pop_name']))
+
+        unnamed = {col for col in union if ' | ' in col} - set(pop_names)
+        not_found = set(pop_names) - union
+
+    # Report mismatched columns, in the order they first appear
+    mismatched = (union - intersection) | unnamed | not_found
+    ordered = [col for header in headers.values() for col in header] + list(pop_names)
+    report_cols = list(dict.fromkeys(col for col in ordered if col in mismatched))
+
+    report = pd.DataFrame({'Column': report_cols})
+    report['Population'] = [parse_col_name(col)[0][-1] for col in report_cols]
+    report['Pop Name'] = [pop_names.get(col) for col in report_cols]
+    for file, header in headers.items():
+        report[file] = [col in header for col in report_cols]
+
+    if union - intersection:
+        logging.warning(str(len(union - intersection)) + ' columns are not in every CSV file. '
+                        'See returned schema report for details.')
+    if unnamed:
+        logging.warning(str(len(unnamed)) + ' population columns are not in the population names CSV.')
+    if not_found:
+        logging.warning(str(len(not_found)) + ' population names CSV columns are not in any CSV file.')
+
+    schema = {'files': headers, 'union': union, 'intersection': intersection, 'missing': missing,
+              'unnamed': unnamed, 'not_found': not_found, 'report': report}
+
+    return schema
+
+
+def make_load_plan(schema, float_dtype='float64'):
+    """
+    Creates 'usecols' and 'dtype' arguments of pandas.read_csv for each file in a prescan schema.
+    Population columns that are not in the population names CSV are not loaded.
+
+    Parameters
+    ----------
+    schema : dict
+        Output of 'prescan_csv_headers'
+    float_dtype : str
+        dtype of the population columns
+
+    Returns
+    -------
+    load_plan : dict
+        dict of file: {'usecols': list, 'dtype': dict}
+
+    """
+
+    load_plan = {}
+    for file, header in schema['files'].items():
+        usecols = [col for col in header if col not in schema['unnamed']]
+        dtype = {col: float_dtype for col in usecols if ' | ' in col}
+        load_plan[file] = {'usecols': usecols, 'dtype': dtype}
+
+    return load_plan
+
+
+def load_csvs_to_dataframe(local_dir, search_string=None, exclude_files=None, load_plan=None,
+                           downcast=False, masked=False):
+    """
+    Loads CSV files in directory and concatenates into a DataFrame.
+
+    Parameters
+    ----------
+    local_dir : string
+        absolute path to CSV data on local machine.
+    search_string : string
+        includes all CSV filenames with this string.
+    exclude_files : list[string]
+        excludes filenames in list.
+    load_plan : dict
+        Optional. Output of 'make_load_plan'. Loads only the planned files, columns and dtypes.
+    downcast : bool
+        if True, population columns are parsed as float32 (without a float64 copy of the CSV file).
+    masked : bool
+        if True, population columns that are not in every CSV file are stored as sparse columns (see
+        'concat_masked'), instead of filling the rows of the other files with NaN.
+
+    Returns
+    -------
+    DataFrame
+        the DataFrame of all concatenated CSV data
+
+    """
+
+    if load_plan:
+        files = list(load_plan)
+    else:
+        files = list_csv_files(local_dir, search_string, exclude_files)
+
     print(files)
 
     # Loop through files, compare Headers
     df_list = []
     for file in files:
         # load CSV as DataFrame
-        df_data = pd.read_csv(local_dir + file)
+        read_kwargs = load_plan[file] if load_plan else {}
+        if downcast and not load_plan:
+            read_kwargs = {'dtype': {col: 'float32' for col in read_csv_header(local_dir + file) if ' | ' in col}}
+        df_data = pd.read_csv(local_dir + file, **read_kwargs)
+
+        if downcast:
+            df_data = downcast_dataframe(df_data, metadata=False)
 
         # drop Mean and SD rows
         df_data = df_data.drop(df_data[df_data['Unnamed: 0'] == 'Mean'].index)
@@ -55,12 +258,112 @@ def load_csvs_to_dataframe(local_dir, search_string=None, exclude_files=None):
         # add dataframe to list to concatenate
         df_list.append(df_data)
 
-    df_all = pd.concat(df_list, axis=0)
+    if masked:
+        df_all = concat_masked(df_list, files)
+    else:
+        df_all = pd.concat(df_list, axis=0)
+
+    return df_all
+
+
+def concat_masked(df_list, files):
+    """
+    Concatenates DataFrames loaded from CSV files with different population columns (ie: batches stained with
+    different panels). Population columns that are in every DataFrame are concatenated as usual. Population
+    columns that are missing from some DataFrames are stored as sparse columns (pandas SparseArray), which store
+    only the measured rows. The batches that measured each sparse column are saved to
+    df.attrs['measured_batches'].
+
+    Parameters
+    ----------
+    df_list : list[DataFrame]
+        DataFrames loaded from each CSV file
+    files : list[string]
+        CSV filenames of the DataFrames. Used as batch names if there is no 'Treatment Batch' column
+
+    Returns
+    -------
+    df_all : DataFrame
+        the DataFrame of all concatenated CSV data
+
+    """
+
+    columns = list(dict.fromkeys(col for df in df_list for col in df.columns))
+    partial = [col for col in columns if ' | ' in col and not all(col in df.columns for df in df_list)]
+
+    df_all = pd.concat([df.drop(columns=[col for col in partial if col in df.columns]) for df in df_list], axis=0)
+
+    # Batch names and row offsets of each DataFrame
+    batches = []
+    for df, file in zip(df_list, files):
+        if BATCH_COLUMN in df.columns:
+            batches.append(df[BATCH_COLUMN].astype('str').unique().tolist())
+        else:
+            batches.append([file])
+    offsets = np.cumsum([0] + [len(df) for df in df_list])
+
+    measured_batches = {}
+    sparse_columns = {}
+    for col in partial:
+        measured = [i for i, df in enumerate(df_list) if col in df.columns]
+        dtype = np.result_type(*[df_list[i][col].dtype for i in measured])
+
+        # Only one column is dense at a time, while its measured blocks are copied in
+        values = np.full(offsets[-1], np.nan, dtype=dtype)
+        for i in measured:
+            values[offsets[i]:offsets[i + 1]] = df_list[i][col].to_numpy(dtype=dtype)
+
+        sparse_columns[col] = pd.arrays.SparseArray(values, fill_value=np.nan)
+        measured_batches[col] = list(dict.fromkeys(batch for i in measured for batch in batches[i]))
+
+    if partial:
+        print(str(len(partial)) + ' population columns are not in every CSV file, and are stored as sparse columns')
+
+    df_all = pd.concat([df_all, pd.DataFrame(sparse_columns, index=df_all.index)], axis=1)
+    df_all = df_all[columns]
+    df_all.attrs['measured_batches'] = measured_batches
 
     return df_all
 
 
-def check_for_nans(df):
+def downcast_dataframe(df, metadata=True):
+    """
+    Reduces the memory of a DataFrame. Population columns (' | ' in column name) are stored as float32
+    (sparse columns as sparse float32), and metadata string columns are stored as Categorical Type.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame to downcast
+    metadata : bool
+        if True, store metadata string columns as Categorical Type
+
+    Returns
+    -------
+    df : DataFrame
+        Downcast DataFrame
+
+    """
+    pop_col = [col for col in df.columns if ' | ' in col]
+    df = df.astype({col: pd.SparseDtype('float32', np.nan) if isinstance(df[col].dtype, pd.SparseDtype)
+                    else 'float32' for col in pop_col})
+
+    if metadata:
+        str_col = [col for col in df.columns if ' | ' not in col and df[col].dtype == object]
+        df = df.astype({col: 'category' for col in str_col})
+
+    return df
+
+
+def estimate_memory(df):
+    """
+    Returns the memory of a DataFrame in bytes, including the memory of string objects.
+    """
+
+    return df.memory_usage(deep=True).sum()
+
+
+def check_for_nans(df, nan_columns=None):
     """
     Report columns in a concatenated DataFrame that were not merged for all samples due to
     mismatched column header names. Mismatched column headers will result in missing row data (NaNs).
@@ -70,6 +373,9 @@ def check_for_nans(df):
     ----------
     df:
         DataFrame, concatenated from multiple CSV files
+    nan_columns:
+        Optional. List of the columns with missing rows, if known (ie: sparse columns in masked mode).
+        If given, the DataFrame is not scanned for NaNs.
 
     Returns
     -------
@@ -77,16 +383,23 @@ def check_for_nans(df):
         DataFrame, subset of columns with missing rows (NaNs).
 
     """
-    # Get list of columns with NaN values
-    nan_columns = df.columns[df.isna().any()].tolist()
-    df_nan = df[nan_columns]
+    if nan_columns is None:
+        # Get list of columns with NaN values
+        nan_columns = df.columns[df.isna().any()].tolist()
+        df_nan = df[nan_columns]
+
+        # Calculate number of NaNs in each column
+        nan_counts = df.isna().sum()
+
+        # If NaN counts for any column is ~equal to column length, report warning
+        if not (nan_counts == len(df_nan)).any():
+            logging.warning('Column names of CSV files are inconsistent. See returned DataFrame for details.')
 
-    # Calculate number of NaNs in each column
-    nan_counts = df.isna().sum()
+    else:
+        df_nan = df[nan_columns]
 
-    # If NaN counts for any column is ~equal to column length, report warning
-    if not (nan_counts == len(df_nan)).any():
-        logging.warning('Column names of CSV files are inconsistent. See returned DataFrame for details.')
+        if nan_columns:
+            logging.warning('Column names of CSV files are inconsistent. See returned DataFrame for details.')
 
     # Output DataFrame with NaN columns for inspection
     new_col_names = []
@@ -127,7 +440,8 @@ def parse_col_name(col_name):
     return hier, stat
 
 
-def preprocess_csvs(local_path, search_string=None, exclude_files=None):
+def preprocess_csvs(local_path, search_string=None, exclude_files=None, csv_popnames=None, memory_budget=None,
+                    masked=False):
     """
     Preprocesses data from several CSVs. Loads CSV files from local path, removes NaN columns,
     creates list of metadata columns (mdh_col), and converts several columns to Categorical Type.
@@ -140,6 +454,17 @@ def preprocess_csvs(local_path, search_string=None, exclude_files=None):
         Optional. Searches for CSV files with this sub-string in file name.
     exclude_files : list, string
         Optional. List of file names to exclude from loading and concatenating.
+    csv_popnames : string
+        Optional. Path of the MASTER population names CSV, or a DataFrame (see 'load_pop_names'). If given, CSV
+        headers are prescanned and population columns that are not in the population names CSV are not loaded.
+    memory_budget : float
+        Optional. Memory budget in MB. If given, population columns are stored as float32 and metadata columns
+        as Categorical Type. Memory is estimated for each stage, with a warning if an estimate exceeds the
+        budget.
+    masked : bool
+        Optional. if True, population columns that are not in every CSV file (ie: batches with different panels)
+        are stored as sparse columns of the measured rows, and the batches that measured each column are saved
+        to df_data.attrs['measured_batches']. Sparse columns are not scanned for NaNs.
 
     Returns
     -------
@@ -151,18 +476,76 @@ def preprocess_csvs(local_path, search_string=None, exclude_files=None):
         A list of 'df_data' column names that contain Metadata about each row of 'df_data'
 
     """
+    downcast = memory_budget is not None
+
+    # Compare CSV headers before loading
+    load_plan = None
+    if csv_popnames is not None:
+        schema = prescan_csv_headers(local_path, search_string, exclude_files, csv_popnames)
+        load_plan = make_load_plan(schema, float_dtype='float32' if downcast else 'float64')
+
+    # Estimate memory of the CSV files
+    if downcast:
+        files = list(load_plan) if load_plan else list_csv_files(local_path, search_string, exclude_files)
+        csv_size = sum([os.path.getsize(local_path + file) for file in files])
+        flowtree.check_memory_budget('Load CSVs', csv_size, memory_budget)
+
     # Load all data CSVs in local_path and merge into single dataframe
-    df_data = load_csvs_to_dataframe(local_path, search_string, exclude_files)
+    df_data = load_csvs_to_dataframe(local_path, search_string, exclude_files, load_plan,
+                                     downcast=downcast, masked=masked)
+    measured_batches = df_data.attrs.get('measured_batches', {})
+
+    if masked:
+        # Sparse columns are the columns with missing rows, so only the other columns are checked for NaNs
+        df_data_nans = check_for_nans(df_data, nan_columns=list(measured_batches))
+
+        empty_columns = [col for col in df_data.columns if col not in measured_batches and df_data[col].isna().all()]
+        if empty_columns:
+            df_data = df_data.drop(columns=empty_columns)
 
-    # Check for NaN columns
-    df_data_nans = check_for_nans(df_data)
+    else:
+        # Check for NaN columns
+        df_data_nans = check_for_nans(df_data)
 
-    # Drop columns that are entirely NaN
-    df_data = df_data.dropna(axis=1, how='all')
+        # Drop columns that are entirely NaN
+        df_data = df_data.dropna(axis=1, how='all')
 
     # A few other changes
     df_data = df_data.rename(columns={'Count': 'Event Count', 'Unnamed: 0': 'FCS'})
 
+    # Sort rows, and set metadata column types
+    df_data, mdh_col = format_metadata(df_data)
+
+    # Store remaining metadata columns as Categorical Type
+    if downcast:
+        df_data = downcast_dataframe(df_data)
+        flowtree.check_memory_budget('Preprocess CSVs', estimate_memory(df_data), memory_budget)
+
+    if masked:
+        df_data.attrs['measured_batches'] = measured_batches
+
+    return df_data, df_data_nans, mdh_col
+
+
+def format_metadata(df_data):
+    """
+    Sorts the rows of a concatenated DataFrame by SampleID, stores the metadata columns as strings, and converts
+    several metadata columns to Categorical Type. The last metadata column must be 'Event Count'.
+
+    Parameters
+    ----------
+    df_data : DataFrame
+        Concatenated data, with 'FCS', 'SampleID' and 'Event Count' columns
+
+    Returns
+    -------
+    df_data : DataFrame
+        Sorted data with formatted metadata columns
+    mdh_col : list
+        A list of 'df_data' column names that contain Metadata about each row of 'df_data'
+
+    """
+
     # Reset row index of DataFrame
     df_data = df_data.sort_values('SampleID', axis=0)
     df_data = df_data.reset_index().drop('index', axis=1)
@@ -178,7 +561,7 @@ def preprocess_csvs(local_path, search_string=None, exclude_files=None):
     df_data = make_categorical_column(df_data, ['Control', 'Ablation', 'Hyperthermia'])
     df_data = make_categorical_column(df_data, ['Contra', 'Ipsi'], ignore_nans=True)
 
-    return df_data, df_data_nans, mdh_col
+    return df_data, mdh_col
 
 
 def make_categorical_column(df, cat_order, ignore_nans=False):
@@ -218,9 +601,9 @@ def make_categorical_column(df, cat_order, ignore_nans=False):
 
 
 
-def create_pop_tree(csv_popnames, df, tissue_type=None, show_tree=True):
+def create_pop_tree(csv_popnames, df, tissue_type=None, show_tree=True, memory_budget=None, csv_virtual=None):
     # Load MASTER population names and paired path names into DataFrame
-    names_xref = pd.read_csv(csv_popnames, names=['pop_name', 'PATH_NAME_XREF'])
+    names_xref = load_pop_names(csv_popnames)
 
     # Load the path names from the CSV data into DataFrame
     names_data = pd.DataFrame([x for x in df.columns if ' | ' in x], columns=['PATH_NAME_XREF'])
@@ -233,14 +616,18 @@ def create_pop_tree(csv_popnames, df, tissue_type=None, show_tree=True):
         logging.warning('Mismatched population naming key with loaded DataFrame')
         print("MergeError:", e)
 
-    # Create tree from the validated DataFrame path headers
-    root = flowtree.PopNode(name="Cells")
+    # Create tree from the validated DataFrame path headers, rooted at the top gate (ie: 'Cells')
+    root_names = names_data['PATH_NAME_CLEAN'].str.split('/').str[0].unique()
+    root = flowtree.PopNode(name=root_names[0] if len(root_names) == 1 else "Cells")
     root = bigtree.add_dataframe_to_tree_by_path(root, names_data, path_col='PATH_NAME_CLEAN',
                                                  attribute_cols=['pop_name'])
 
     # Specify the metadata (MDH) columns for the DataFrame
     mdh_col = [col for col in df.columns.to_list() if ' | ' not in col]
 
+    # Batches that measured each sparse column (masked mode, see 'preprocess_csvs')
+    measured_batches = df.attrs.get('measured_batches', {})
+
     # Loop through tree descendents, adding data attribute to each tree node
     all_nodes = [root] + [x for x in root.descendants]
     for node in all_nodes:
@@ -256,6 +643,10 @@ def create_pop_tree(csv_popnames, df, tissue_type=None, show_tree=True):
         data = df[mdh_col + df_col_name]
         data = data.rename(columns={df_col_name[0]: 'Data'})
 
+        # Populations that were not measured in every batch
+        if df_col_name[0] in measured_batches:
+            node.measured_batches = measured_batches[df_col_name[0]]
+
         # Assign the data to the correct Node attribute
         _, stat = parse_col_name(df_col_name[0])
         if 'count' in stat.lower():
@@ -268,6 +659,16 @@ def create_pop_tree(csv_popnames, df, tissue_type=None, show_tree=True):
             node.freq_of_parent = data
             node.avg_freq_of_parent = data['Data'].mean()
 
+    # Add virtual population nodes (sums of existing nodes)
+    if csv_virtual:
+        root.add_virtual_nodes(csv_virtual)
+
+    # Memory budget for calculating counts
+    if memory_budget is not None:
+        root.memory_budget = memory_budget
+        flowtree.check_memory_budget('Create flowtree', len(all_nodes) * estimate_memory(root.freq_of_parent),
+                                     memory_budget)
+
     # Add tissue-type attribute to the tree nodes
     if tissue_type:
         root.tissue = tissue_type
@@ -284,17 +685,7 @@ def create_pop_tree(csv_popnames, df, tissue_type=None, show_tree=True):
 
 def export_df_to_csv(df, csv_filename, headers=None):
 
-    if headers:
-        if not len(df.columns.to_list()) == len(headers):
-            logging.warning('Export to CSV error: Header column list does not match DataFrame header columns.')
-
-    with open(csv_filename, 'w') as f:
-        # f.write('\n'.join([','.join(line) for line in header]) + '\n')
-        if headers:
-            writer = csv.writer(f)
-            writer.writerow(headers)
-
-        df.to_csv(f, index=False, header=True)
+    export_tools.write_csv(df, csv_filename, headers)
 
 
 #def check_pop_names(df, csv):
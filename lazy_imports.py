@@ -0,0 +1,113 @@
+import importlib
+import importlib.util
+import subprocess
+import sys
+import threading
+import types
+
+
+_import_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module that is imported when one of its attributes is first used.
+    The placeholder is registered in sys.modules, so 'import <name>' statements in other packages
+    (ie: pandas in bigtree) do not import the module either.
+    """
+
+    def __init__(self, name, spec):
+        super().__init__(name)
+        self.__spec__ = spec
+
+    def __getattr__(self, attr):
+        with _import_lock:
+            module = self.__dict__.get('_lazy_module')
+
+            if module is None:
+                # Replace the placeholder with the imported module
+                if sys.modules.get(self.__name__) is self:
+                    del sys.modules[self.__name__]
+                try:
+                    module = importlib.import_module(self.__name__)
+                except BaseException:
+                    sys.modules[self.__name__] = self
+                    raise
+
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    Returns module 'name', without importing it until one of its attributes is first used.
+    Modules that are already imported are returned as they are.
+
+    Parameters
+    ----------
+    name : str
+        Module name (ie: 'pandas')
+
+    Returns
+    ----------
+    module : object
+        Imported module, or LazyModule placeholder
+    """
+
+    with _import_lock:
+        if name in sys.modules:
+            return sys.modules[name]
+
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError('No module named ' + repr(name), name=name)
+
+        module = LazyModule(name, spec)
+        sys.modules[name] = module
+
+    return module
+
+
+def is_available(name):
+    """Returns True if module 'name' can be imported, without importing it."""
+
+    return name in sys.modules or importlib.util.find_spec(name) is not None
+
+
+def measure_import_time(module_name):
+    """
+    Measures the import time of a module in a new Python process (cold import).
+
+    Parameters
+    ----------
+    module_name : str
+        Module to import (ie: 'flowtree')
+
+    Returns
+    ----------
+    import_ms : float
+        Import time in milliseconds
+    """
+
+    code = ('import time\n'
+            't = time.perf_counter()\n'
+            'import ' + module_name + '\n'
+            'print((time.perf_counter() - t) * 1000)')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+
+    # Import-time budget check: python lazy_imports.py flowtree 200
+    module_name = sys.argv[1] if len(sys.argv) > 1 else 'flowtree'
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    import_ms = min([measure_import_time(module_name) for _ in range(3)])
+    print('import ' + module_name + ': ' + str(round(import_ms, 1)) + ' ms (budget ' + str(budget_ms) + ' ms)')
+
+    if import_ms > budget_ms:
+        sys.exit('Import time of ' + module_name + ' exceeds the budget.')
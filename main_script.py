@@ -32,22 +32,27 @@ def main(get_remote, toss_files):
     if get_remote:
         get_remote_data(remotepath, fcspath, server_json)
 
-    # Load CSVs and concatenate into dataframe
+    # MASTER population names for each tissue
+    csv_popnames_tumor = datapath + 'Tumor Population Names.csv'
+    csv_popnames_spleen = datapath + 'Spleen Population Names.csv'
+
+    # Prescan CSV headers, load CSVs and concatenate into dataframe
     print('Loading CSVs for Tumor data: ')
     df_tumor, df_tumor_nans, mdh_tumor = import_tools.preprocess_csvs(fcspath,
                                                                       search_string='Tumor',
-                                                                      exclude_files=toss_files)
+                                                                      exclude_files=toss_files,
+                                                                      csv_popnames=csv_popnames_tumor)
     print('Loading CSVs for Spleen data: ')
     df_spleen, df_spleen_nans, mdh_spleen = import_tools.preprocess_csvs(fcspath,
                                                                          search_string='Spleen',
-                                                                         exclude_files=toss_files)
+                                                                         exclude_files=toss_files,
+                                                                         csv_popnames=csv_popnames_spleen)
 
     # ----- CREATE FLOWTREES -------
 
     # Create population flowtree for TUMOR tissue dataframe
     print('Creating population tree for Tumor data: ')
-    csv_popnames_master = datapath + 'Tumor Population Names.csv'
-    tumor_root = import_tools.create_pop_tree(csv_popnames_master,
+    tumor_root = import_tools.create_pop_tree(csv_popnames_tumor,
                                               df_tumor,
                                               tissue_type='tumor',
                                               show_tree=False)
@@ -58,8 +63,7 @@ def main(get_remote, toss_files):
 
     # Create population flowtree for SPLEEN tissue dataframe
     print('Creating population tree for Spleen data: ')
-    csv_popnames_master = datapath + 'Spleen Population Names.csv'
-    spleen_root = import_tools.create_pop_tree(csv_popnames_master,
+    spleen_root = import_tools.create_pop_tree(csv_popnames_spleen,
                                                df_spleen,
                                                tissue_type='spleen',
                                                show_tree=False)
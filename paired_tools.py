@@ -0,0 +1,220 @@
+import logging
+import lazy_imports
+
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+
+COMPARISONS = ['ratio', 'log2_ratio', 'difference']
+CORRELATIONS = ['pearson', 'spearman']
+
+
+class PairedFlowtrees:
+    """
+    Paired view of two or more flowtrees from the same animals (ie: tumor and spleen).
+    Samples are aligned on 'on_column' once, and populations are matched by 'pop_name'.
+    Population data is gathered from each flowtree by the aligned row positions.
+
+    Parameters
+    ----------
+    trees : dict
+        dict of tree name: PopNode flowtree (ie: {'tumor': tumor_root, 'spleen': spleen_root})
+    on_column : str
+        Metadata column identifying the animal in every flowtree. Default is "SampleID"
+    """
+
+    def __init__(self, trees, on_column='SampleID'):
+        self.trees = {name: root.root for name, root in trees.items()}
+        self.on_column = on_column
+        self.matrices = {}
+
+        # Sample keys of each flowtree, in flowtree row order
+        keys = {}
+        for name, root in self.trees.items():
+            keys[name] = pd.Index(root.get_sample_metadata()[on_column].astype('str'))
+            if keys[name].has_duplicates:
+                logging.warning(name + ' flowtree has duplicate ' + on_column + ' rows. Only the first row is paired.')
+
+        # Samples in all flowtrees, in the order of the first flowtree
+        first = list(keys.values())[0]
+        shared = first[first.isin(set.intersection(*[set(x) for x in keys.values()]))].unique()
+        self.samples = pd.Index(shared, name=on_column)
+
+        for name, key in keys.items():
+            unpaired = len(key.unique()) - len(self.samples)
+            if unpaired:
+                logging.warning(str(unpaired) + ' samples of the ' + name + ' flowtree are not in every flowtree.')
+
+        # Row position of each shared sample in each flowtree
+        self.positions = {}
+        for name, key in keys.items():
+            first_rows = ~key.duplicated(keep='first')
+            self.positions[name] = np.flatnonzero(first_rows)[key[first_rows].get_indexer(self.samples)]
+
+        # Populations in all flowtrees, in the order of the first flowtree
+        pop_names = {name: [root.pop_name] + [node.pop_name for node in root.descendants]
+                     for name, root in self.trees.items()}
+        first = list(pop_names.values())[0]
+        self.pop_names = [pop for pop in first if all(pop in x for x in pop_names.values())]
+
+    def get_metadata(self, name):
+        """Returns the metadata columns of flowtree 'name' for the paired samples, indexed by 'on_column'."""
+
+        metadata = self.trees[name].get_sample_metadata().iloc[self.positions[name]]
+
+        return metadata.set_index(self.samples)
+
+    def get_matrix(self, name, stat='counts', populations=None):
+        """
+        Returns paired samples x populations matrix of flowtree 'name'.
+
+        Parameters
+        ----------
+        name : str
+            Name of the flowtree
+        stat : str
+            'counts', 'freq_of_parent', or the 'pop_name' of an ancestor population to calculate the frequency of
+        populations : list[str]
+            Optional. 'pop_name' attributes of the populations. Default is all shared populations
+
+        Returns
+        ----------
+        df_matrix : object
+            DataFrame indexed by 'on_column', with one column per population
+        """
+
+        if populations is None:
+            populations = self.get_populations(stat)
+
+        key = (name, stat)
+        if key not in self.matrices:
+            root = self.trees[name]
+            df_features = root.get_feature_matrix(stat, populations=self.get_populations(stat),
+                                                  index_cols=(self.on_column,), dropna=False)
+
+            # Gather the paired samples by row position
+            self.matrices[key] = pd.DataFrame(df_features.to_numpy()[self.positions[name]],
+                                              index=self.samples, columns=df_features.columns)
+
+        return self.matrices[key][populations]
+
+    def get_populations(self, stat='counts'):
+        """Returns the shared populations that have 'stat' in every flowtree."""
+
+        if stat in ['counts', 'freq_of_parent']:
+            # The flowtree root has no parent population
+            return self.pop_names[1:] if stat == 'freq_of_parent' else self.pop_names
+
+        populations = []
+        for pop in self.pop_names:
+            nodes = [root.find_popname(pop) for root in self.trees.values()]
+            ancestors = [root.find_popname(stat) for root in self.trees.values()]
+            if all(node.is_descendant_of(ancestor) for node, ancestor in zip(nodes, ancestors)):
+                populations.append(pop)
+
+        return populations
+
+    def compare(self, name_a, name_b, stat='counts', how='ratio', populations=None):
+        """
+        Per-animal comparison of every shared population between two flowtrees (ie: tumor vs. spleen).
+
+        Parameters
+        ----------
+        name_a, name_b : str
+            Names of the flowtrees to compare (name_a / name_b, or name_a - name_b)
+        stat : str
+            'counts', 'freq_of_parent', or the 'pop_name' of an ancestor population to calculate the frequency of
+        how : str
+            'ratio', 'log2_ratio' or 'difference'
+        populations : list[str]
+            Optional. 'pop_name' attributes of the populations. Default is all shared populations
+
+        Returns
+        ----------
+        df_compare : object
+            DataFrame indexed by 'on_column', with one column per population
+        """
+
+        if how not in COMPARISONS:
+            raise ValueError('Unknown comparison: ' + how + '. Choose one of ' + ', '.join(COMPARISONS))
+
+        a = self.get_matrix(name_a, stat, populations)
+        b = self.get_matrix(name_b, stat, populations)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if how == 'ratio':
+                values = a.to_numpy() / b.to_numpy()
+            elif how == 'log2_ratio':
+                values = np.log2(a.to_numpy() / b.to_numpy())
+            else:
+                values = a.to_numpy() - b.to_numpy()
+
+        return pd.DataFrame(values, index=a.index, columns=a.columns)
+
+    def correlate(self, name_a, name_b, stat='freq_of_parent', method='pearson', populations=None):
+        """
+        Correlation across animals of every shared population between two flowtrees. Samples missing in either
+        flowtree are excluded for each population.
+
+        Parameters
+        ----------
+        name_a, name_b : str
+            Names of the flowtrees to correlate
+        stat : str
+            'counts', 'freq_of_parent', or the 'pop_name' of an ancestor population to calculate the frequency of
+        method : str
+            'pearson' or 'spearman'
+        populations : list[str]
+            Optional. 'pop_name' attributes of the populations. Default is all shared populations
+
+        Returns
+        ----------
+        df_corr : object
+            DataFrame indexed by population, with correlation coefficient 'r' and number of paired samples 'n'
+        """
+
+        if method not in CORRELATIONS:
+            raise ValueError('Unknown correlation method: ' + method + '. Choose one of ' + ', '.join(CORRELATIONS))
+
+        a = self.get_matrix(name_a, stat, populations).to_numpy(dtype='float64')
+        b = self.get_matrix(name_b, stat, populations).to_numpy(dtype='float64')
+
+        # Exclude samples missing in either flowtree, per population
+        valid = ~(np.isnan(a) | np.isnan(b))
+        a = np.where(valid, a, np.nan)
+        b = np.where(valid, b, np.nan)
+
+        if method == 'spearman':
+            a = pd.DataFrame(a).rank().to_numpy()
+            b = pd.DataFrame(b).rank().to_numpy()
+
+        n = valid.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = a - np.nanmean(a, axis=0)
+            b = b - np.nanmean(b, axis=0)
+            r = np.nansum(a * b, axis=0) / np.sqrt(np.nansum(a ** 2, axis=0) * np.nansum(b ** 2, axis=0))
+
+        r[n < 3] = np.nan
+        columns = self.get_matrix(name_a, stat, populations).columns
+
+        return pd.DataFrame({'r': r, 'n': n}, index=pd.Index(columns, name='pop_name'))
+
+    def get_paired_frame(self, stat='counts', populations=None):
+        """
+        Returns the paired data of all flowtrees side by side, for export.
+
+        Returns
+        ----------
+        df_paired : object
+            DataFrame indexed by 'on_column', with '<pop_name> | <tree name>' columns
+        """
+
+        frames = []
+        for name in self.trees:
+            df = self.get_matrix(name, stat, populations)
+            frames.append(df.rename(columns={pop: pop + ' | ' + name for pop in df.columns}))
+
+        df_paired = pd.concat(frames, axis=1)
+        order = [pop + ' | ' + name for pop in frames[0].columns.str.rsplit(' | ', n=1).str[0]
+                 for name in self.trees]
+
+        return df_paired[order]
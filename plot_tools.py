@@ -0,0 +1,233 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+import lazy_imports
+
+# plotnine is imported when the first figure is rendered
+pd = lazy_imports.lazy_import('pandas')
+p9 = lazy_imports.lazy_import('plotnine')
+
+
+# Increment when the rendering in 'render_plot' changes, so previously cached figures are not reused
+PLOT_VERSION = 1
+
+# Statistic names of population counts, as in 'PopNode.get_feature_matrix' ('count' is accepted for earlier scripts)
+COUNT_STATISTICS = ['counts', 'count']
+
+
+def get_plot_data(root, population, statistic='freq_of_parent', x_var='Treatment Group'):
+    """
+    Collect the data slice used to plot one population statistic.
+
+    Parameters
+    ----------
+    root : object
+        PopNode object, flowtree to collect data from
+    population : str
+        'pop_name' attribute of the population node to plot
+    statistic : str
+        'freq_of_parent', 'counts', or the 'pop_name' of an ancestor population to plot the frequency of
+    x_var : str
+        Metadata column to compare the population across (ie: Treatment Group)
+
+    Returns
+    -------
+    df_plot : DataFrame
+        DataFrame with 'x_var' and 'Data' columns
+    stat_name_pop : str
+        Stat description using node 'popname' attributes
+    """
+
+    node = root.find_popname(population)
+
+    if statistic == 'freq_of_parent':
+        df, _, stat_name_pop = node.get_freq()
+    elif statistic in COUNT_STATISTICS:
+        df, _, stat_name_pop = node.get_count()
+    else:
+        df, _, stat_name_pop = node.get_freq_of_ancestor(statistic)
+
+    df_plot = df[[x_var, 'Data']].reset_index(drop=True)
+
+    # Sparse columns (masked mode) are plotted and hashed as dense columns
+    if isinstance(df_plot['Data'].dtype, pd.SparseDtype):
+        df_plot['Data'] = df_plot['Data'].sparse.to_dense()
+
+    return df_plot, stat_name_pop
+
+
+def hash_plot_inputs(df_plot, spec):
+    """
+    Hash the data slice and plot spec of a figure. Figures with equal hashes render to the same output.
+
+    Parameters
+    ----------
+    df_plot : DataFrame
+        Data slice of the figure, from 'get_plot_data'
+    spec : dict
+        Plot spec of the figure (labels, size, file format)
+
+    Returns
+    -------
+    str
+        Hex digest of the figure inputs
+    """
+
+    # The category order sets the order of the boxes, and is not part of the hashed values
+    categories = {str(col): [str(x) for x in df_plot[col].cat.categories] for col in df_plot.columns
+                  if isinstance(df_plot[col].dtype, pd.CategoricalDtype)}
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps(dict(spec, plot_version=PLOT_VERSION, categories=categories), sort_keys=True).encode())
+    sha.update(json.dumps([str(col) for col in df_plot.columns]).encode())
+    sha.update(pd.util.hash_pandas_object(df_plot, index=False).to_numpy().tobytes())
+
+    return sha.hexdigest()
+
+
+def render_plot(df_plot, spec, filename):
+    """
+    Render a boxplot of 'Data' grouped by the spec 'x_var' column, and save to 'filename'.
+    Runs in the worker processes of 'batch_plot'.
+
+    Parameters
+    ----------
+    df_plot : DataFrame
+        Data slice of the figure, from 'get_plot_data'
+    spec : dict
+        Plot spec of the figure, from 'batch_plot'
+    filename : str
+        Path of the saved figure
+
+    Returns
+    -------
+    filename : str
+        Path of the saved figure
+    """
+
+    plot = (p9.ggplot(df_plot, p9.aes(x=spec['x_var'], y='Data', fill=spec['x_var']))
+            + p9.geom_boxplot(outlier_shape='', alpha=0.5)
+            + p9.geom_jitter(width=0.15, height=0, size=1.5)
+            + p9.labs(title=spec['title'], x=spec['x_var'], y=spec['y_label']))
+
+    if lazy_imports.is_available('plotnine_prism'):
+        from plotnine_prism import theme_prism
+        plot = plot + theme_prism()
+    else:
+        plot = plot + p9.theme_bw()
+
+    plot = plot + p9.theme(legend_position='none')
+
+    # Save to a temporary file first, so interrupted renders are never taken from the cache
+    temp_filename = filename + '.tmp.' + spec['file_format']
+    plot.save(temp_filename, width=spec['width'], height=spec['height'], dpi=spec['dpi'], verbose=False)
+    os.replace(temp_filename, filename)
+
+    return filename
+
+
+def batch_plot(root, populations, statistics, x_var='Treatment Group', cache_dir='figure_cache',
+               export_dir=None, n_workers=None, file_format='png', width=4, height=4, dpi=300):
+    """
+    Render a figure for every population and statistic in a process pool.
+    Figures are saved in 'cache_dir' by the hash of their inputs (data slice + plot spec), and
+    figures that have already been rendered are not rendered again.
+
+    Parameters
+    ----------
+    root : object
+        PopNode object, flowtree to collect data from
+    populations : list[str]
+        'pop_name' attributes of the population nodes to plot
+    statistics : list[str]
+        'freq_of_parent', 'counts', or the 'pop_name' of ancestor populations to plot the frequency of.
+        Ancestors that are not an ancestor of a population are skipped
+    x_var : str
+        Metadata column to compare the populations across (ie: Treatment Group)
+    cache_dir : str
+        Directory of the figure cache
+    export_dir : str
+        Optional. Directory to copy the figures to, named by population and statistic
+    n_workers : int
+        Number of worker processes. Default is the number of CPUs
+    file_format : str
+        Figure file format (ie: png, pdf, svg)
+    width, height : float
+        Figure size in inches
+    dpi : int
+        Figure resolution
+
+    Returns
+    -------
+    df_figures : DataFrame
+        One row per figure, with the 'population', 'statistic', 'stat_name', 'filename' and 'cached' columns
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    figures = []
+    jobs = []
+    for population in populations:
+        node = root.find_popname(population)
+
+        for statistic in statistics:
+
+            if statistic not in ['freq_of_parent'] + COUNT_STATISTICS and \
+                    not node.is_descendant_of(root.find_popname(statistic)):
+                logging.warning(statistic + ' is not an ancestor of ' + population)
+                continue
+
+            df_plot, stat_name_pop = get_plot_data(root, population, statistic, x_var)
+
+            y_label = 'Count' if statistic in COUNT_STATISTICS else stat_name_pop.split(' | ')[-1]
+            spec = {'x_var': x_var, 'title': population, 'y_label': y_label,
+                    'file_format': file_format, 'width': width, 'height': height, 'dpi': dpi}
+
+            filename = os.path.join(cache_dir, hash_plot_inputs(df_plot, spec) + '.' + file_format)
+            cached = os.path.exists(filename)
+
+            figures.append({'population': population, 'statistic': statistic, 'stat_name': stat_name_pop,
+                            'filename': filename, 'cached': cached})
+
+            # Figures with identical inputs are only rendered once
+            if not cached and filename not in [job[2] for job in jobs]:
+                jobs.append((df_plot, spec, filename))
+
+    print(str(len(jobs)) + ' figures to render, ' + str(len(figures) - len(jobs)) + ' figures in cache')
+
+    failed = []
+    if n_workers == 1 or len(jobs) <= 1:
+        for df_plot, spec, filename in jobs:
+            try:
+                render_plot(df_plot, spec, filename)
+            except Exception as err:
+                logging.warning('Figure could not be rendered: ' + spec['title'] + ' ' + str(err))
+                failed.append(filename)
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(render_plot, *job): job for job in jobs}
+
+            for future in concurrent.futures.as_completed(futures):
+                _, spec, filename = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    logging.warning('Figure could not be rendered: ' + spec['title'] + ' ' + str(err))
+                    failed.append(filename)
+
+    df_figures = pd.DataFrame(figures, columns=['population', 'statistic', 'stat_name', 'filename', 'cached'])
+    df_figures = df_figures[~df_figures['filename'].isin(failed)].reset_index(drop=True)
+
+    # Copy figures to readable file names
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+
+        for _, row in df_figures.iterrows():
+            export_name = (row['population'] + ' - ' + row['statistic']).replace('/', '_')
+            shutil.copyfile(row['filename'], os.path.join(export_dir, export_name + '.' + file_format))
+
+    return df_figures
@@ -0,0 +1,170 @@
+import logging
+import lazy_imports
+
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+
+DISTANCE_METRICS = ['euclidean', 'correlation', 'braycurtis']
+
+# Memory (bytes) of the intermediate array of one block of Bray-Curtis distances, without scipy
+BLOCK_MEMORY = 64e6
+
+
+def pairwise_distances(df_features, metric='euclidean', block_size=1024):
+    """
+    Calculate the distances between all pairs of samples (rows) of a feature matrix.
+    Distances are calculated in blocks of rows, with vectorized array operations (scipy 'cdist' for
+    Bray-Curtis, if installed).
+
+    Parameters
+    ----------
+    df_features : DataFrame
+        Samples x populations feature matrix (ie: from PopNode 'get_feature_matrix')
+    metric : str
+        'euclidean', 'correlation' (1 - Pearson correlation of the sample profiles) or 'braycurtis'
+    block_size : int
+        Number of rows per block
+
+    Returns
+    -------
+    df_distances : DataFrame
+        Samples x samples distance matrix, indexed by the feature matrix index
+    """
+
+    if metric not in DISTANCE_METRICS:
+        raise ValueError('Unknown distance metric: ' + metric + '. Choose one of ' + ', '.join(DISTANCE_METRICS))
+
+    x = df_features.to_numpy(dtype='float64')
+    if np.isnan(x).any():
+        raise ValueError('Feature matrix has missing values. Drop or fill them before calculating distances.')
+
+    n_samples, n_features = x.shape
+    distances = np.empty((n_samples, n_samples))
+
+    if metric == 'euclidean':
+        sq_norms = (x ** 2).sum(axis=1)
+        for start in range(0, n_samples, block_size):
+            block = slice(start, start + block_size)
+            d2 = sq_norms[block, None] + sq_norms[None, :] - 2 * (x[block] @ x.T)
+            distances[block] = np.sqrt(np.maximum(d2, 0))
+
+    elif metric == 'correlation':
+        z = x - x.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(z, axis=1, keepdims=True)
+        if (norms == 0).any():
+            logging.warning('Samples with constant profiles have undefined correlation distances.')
+        z = z / norms
+        for start in range(0, n_samples, block_size):
+            block = slice(start, start + block_size)
+            distances[block] = 1 - z[block] @ z.T
+
+    elif metric == 'braycurtis' and lazy_imports.is_available('scipy'):
+        from scipy.spatial.distance import cdist
+
+        for start in range(0, n_samples, block_size):
+            block = slice(start, start + block_size)
+            distances[block] = cdist(x[block], x, metric='braycurtis')
+
+    elif metric == 'braycurtis':
+        # Broadcasting creates a (block, n_samples, n_features) array, so blocks are limited by memory
+        block_size = int(max(1, min(block_size, BLOCK_MEMORY // (8 * n_samples * max(n_features, 1)))))
+        sums = x.sum(axis=1)
+        for start in range(0, n_samples, block_size):
+            block = slice(start, start + block_size)
+            abs_diff = np.abs(x[block, None, :] - x[None, :, :]).sum(axis=2)
+            distances[block] = abs_diff / (sums[block, None] + sums[None, :])
+
+    # Remove round-off error on the diagonal
+    np.fill_diagonal(distances, 0)
+
+    return pd.DataFrame(distances, index=df_features.index, columns=df_features.index)
+
+
+def hierarchical_clustering(df_distances, method='average', n_clusters=None, distance_threshold=None):
+    """
+    Hierarchical (agglomerative) clustering of samples from a distance matrix.
+
+    Parameters
+    ----------
+    df_distances : DataFrame
+        Samples x samples distance matrix, from 'pairwise_distances'
+    method : str
+        Linkage method: 'average', 'complete', 'single', 'weighted' (or 'ward' for euclidean distances)
+    n_clusters : int
+        Optional. Number of clusters to assign samples to
+    distance_threshold : float
+        Optional. Assign clusters by cutting the tree at this distance (used if n_clusters is None)
+
+    Returns
+    -------
+    linkage : ndarray
+        scipy linkage matrix (ie: for scipy.cluster.hierarchy.dendrogram)
+    clusters : Series
+        Cluster number of each sample, indexed by the distance matrix index. None if neither n_clusters
+        nor distance_threshold is given
+    """
+
+    from scipy.cluster import hierarchy
+    from scipy.spatial.distance import squareform
+
+    # Make the distance matrix exactly symmetric before converting to condensed form
+    d = df_distances.to_numpy(dtype='float64')
+    d = (d + d.T) / 2
+    linkage = hierarchy.linkage(squareform(d, checks=False), method=method)
+
+    clusters = None
+    if n_clusters is not None:
+        clusters = hierarchy.fcluster(linkage, n_clusters, criterion='maxclust')
+    elif distance_threshold is not None:
+        clusters = hierarchy.fcluster(linkage, distance_threshold, criterion='distance')
+
+    if clusters is not None:
+        clusters = pd.Series(clusters, index=df_distances.index, name='Cluster')
+
+    return linkage, clusters
+
+
+def pca(df_features, n_components=2, scale=True):
+    """
+    Principal component analysis of a feature matrix, by singular value decomposition.
+
+    Parameters
+    ----------
+    df_features : DataFrame
+        Samples x populations feature matrix (ie: from PopNode 'get_feature_matrix')
+    n_components : int
+        Number of principal components to return
+    scale : bool
+        if True, scale each population to unit variance before PCA
+
+    Returns
+    -------
+    df_scores : DataFrame
+        Samples x components scores, indexed by the feature matrix index
+    explained_variance : Series
+        Fraction of the total variance explained by each component
+    df_loadings : DataFrame
+        Populations x components loadings
+    """
+
+    x = df_features.to_numpy(dtype='float64')
+    if np.isnan(x).any():
+        raise ValueError('Feature matrix has missing values. Drop or fill them before PCA.')
+
+    x = x - x.mean(axis=0)
+    if scale:
+        std = x.std(axis=0, ddof=1)
+        std[std == 0] = 1
+        x = x / std
+
+    u, s, vt = np.linalg.svd(x, full_matrices=False)
+    n_components = min(n_components, len(s))
+    components = ['PC' + str(i + 1) for i in range(n_components)]
+
+    variance = s ** 2
+    explained_variance = pd.Series(variance[:n_components] / variance.sum(), index=components)
+
+    df_scores = pd.DataFrame(u[:, :n_components] * s[:n_components], index=df_features.index, columns=components)
+    df_loadings = pd.DataFrame(vt[:n_components].T, index=df_features.columns, columns=components)
+
+    return df_scores, explained_variance, df_loadings
@@ -0,0 +1,275 @@
+import logging
+import xml.etree.ElementTree as ElementTree
+import lazy_imports
+import flowtree
+import import_tools
+
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+
+# FlowJo keywords saved as metadata columns (the keyword columns of the FlowJo CSV tables)
+WSP_KEYWORDS = ['SampleID', 'Treatment Batch', 'Treatment Group']
+
+# Workspace elements of gated populations (boolean gates are saved as Not/Or/And nodes)
+POPULATION_TAGS = ['Population', 'NotNode', 'OrNode', 'AndNode']
+
+
+def local_name(tag):
+    """Returns an XML tag without its namespace."""
+
+    return tag.rsplit('}', 1)[-1]
+
+
+def to_float(value):
+    """Returns an XML attribute value as float, or NaN if it is missing."""
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def iter_wsp_samples(wsp_file, keywords=WSP_KEYWORDS):
+    """
+    Parses a FlowJo workspace (.wsp) file one sample at a time. The XML is read with a streaming parser, and
+    each sample element is removed from the tree once it is parsed, so memory does not grow with the number of
+    samples.
+
+    Parameters
+    ----------
+    wsp_file : str
+        Path of the FlowJo workspace file
+    keywords : list[str]
+        FlowJo keywords to collect for each sample ('$FIL' is always collected)
+
+    Yields
+    ----------
+    sample : dict
+        'FCS' (sample name), 'Event Count' (events of the sample), 'keywords' (dict of keyword: value) and
+        'populations' (dict of gate path: event count, ie: {'Cells/Live': 166514.0})
+    """
+
+    # '$FIL' (FCS file name) names samples without a SampleNode name
+    collect = set(keywords) | {'$FIL'}
+
+    stack = []
+    gate_path = []
+    sample = None
+    for event, elem in ElementTree.iterparse(wsp_file, events=('start', 'end')):
+        tag = local_name(elem.tag)
+
+        if event == 'start':
+            stack.append(elem)
+
+            if tag == 'Sample':
+                sample = {'FCS': None, 'Event Count': np.nan, 'keywords': {}, 'populations': {}}
+
+            elif sample is None:
+                continue
+
+            elif tag == 'Keyword' and elem.get('name') in collect:
+                sample['keywords'][elem.get('name')] = elem.get('value')
+
+            elif tag == 'SampleNode':
+                sample['FCS'] = elem.get('name')
+                sample['Event Count'] = to_float(elem.get('count'))
+
+            elif tag in POPULATION_TAGS:
+                # '/' separates the gates of a path, so it is not used in gate names
+                gate_path.append((elem.get('name') or '').replace('/', '_'))
+                sample['populations']['/'.join(gate_path)] = to_float(elem.get('count'))
+
+            continue
+
+        stack.pop()
+
+        if tag in POPULATION_TAGS and sample is not None:
+            gate_path.pop()
+
+        elif tag == 'Sample':
+            # Sample elements are removed once parsed
+            stack[-1].remove(elem)
+            if sample['FCS'] is None:
+                sample['FCS'] = sample['keywords'].get('$FIL')
+            yield sample
+            sample = None
+
+        elif len(stack) == 1:
+            # Other sections of the workspace (ie: group gating templates) are not used
+            stack[0].remove(elem)
+
+
+def parse_workspace(wsp_file, search_string=None, keywords=WSP_KEYWORDS):
+    """
+    Parses the per-sample population counts of a FlowJo workspace (.wsp) file into a DataFrame in the format of
+    'import_tools.preprocess_csvs': 'FCS', population 'Freq. of Parent' columns (full gate path column names, as
+    in the FlowJo CSV tables), keyword metadata columns and 'Event Count'.
+
+    Parameters
+    ----------
+    wsp_file : str
+        Path of the FlowJo workspace file
+    search_string : str
+        Optional. Includes the samples with this sub-string in the sample name (ie: 'Tumor')
+    keywords : list[str]
+        FlowJo keywords saved as metadata columns
+
+    Returns
+    ----------
+    df_data : DataFrame
+        Freq of Parent (%) of all populations, with metadata columns
+    df_counts : DataFrame
+        Event counts of all populations (full gate path column names), in the row order of 'df_data'
+    mdh_col : list
+        A list of 'df_data' column names that contain Metadata about each row of 'df_data'
+    """
+
+    # Per-sample values are collected in lists, and populations are matched to columns once at the end
+    fcs = []
+    event_counts = []
+    sample_keywords = {keyword: [] for keyword in keywords}
+    sample_populations = []
+    for sample in iter_wsp_samples(wsp_file, keywords):
+        if search_string and search_string not in (sample['FCS'] or ''):
+            continue
+
+        fcs.append(sample['FCS'])
+        event_counts.append(sample['Event Count'])
+        for keyword in keywords:
+            sample_keywords[keyword].append(sample['keywords'].get(keyword))
+        sample_populations.append(sample['populations'])
+
+    print(str(len(fcs)) + ' samples parsed from ' + wsp_file)
+    if not fcs:
+        raise ValueError('No samples were found in the FlowJo workspace: ' + wsp_file)
+
+    paths = list(dict.fromkeys(path for populations in sample_populations for path in populations))
+    columns = {path: i for i, path in enumerate(paths)}
+
+    counts = np.full((len(fcs), len(paths)), np.nan)
+    for i, populations in enumerate(sample_populations):
+        counts[i, [columns[path] for path in populations]] = list(populations.values())
+
+    missing = np.isnan(counts).any(axis=0)
+    if missing.any():
+        logging.warning(str(missing.sum()) + ' populations are not gated (or have no counts) in every sample.')
+
+    # Freq of Parent (%) from the counts of each population and its parent (or the sample event count)
+    event_counts = np.array(event_counts, dtype='float64')
+    parent_counts = np.column_stack([counts[:, columns[path.rsplit('/', 1)[0]]] if '/' in path else event_counts
+                                     for path in paths])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = 100 * counts / parent_counts
+
+    df_metadata = pd.DataFrame(sample_keywords)
+    for keyword in keywords:
+        # Numeric keywords are float, as in the FlowJo CSV tables
+        numeric = pd.to_numeric(df_metadata[keyword], errors='coerce')
+        if numeric.notna().sum() == df_metadata[keyword].notna().sum():
+            df_metadata[keyword] = numeric.astype('float64')
+
+    count_cols = [path + ' | Count' for path in paths]
+    df_data = pd.concat([pd.DataFrame({'FCS': fcs}),
+                         pd.DataFrame(freqs, columns=[path + ' | Freq. of Parent' for path in paths]),
+                         pd.DataFrame(counts, columns=count_cols),
+                         df_metadata,
+                         pd.DataFrame({'Event Count': event_counts})], axis=1)
+
+    # Sort rows and set metadata column types, as for the CSV tables. Counts are sorted with the rows
+    df_data, mdh_col = import_tools.format_metadata(df_data)
+    df_counts = df_data[count_cols].rename(columns=dict(zip(count_cols, paths)))
+    df_data = df_data.drop(columns=count_cols)
+
+    return df_data, df_counts, mdh_col
+
+
+def make_pop_names(df_data):
+    """
+    Creates population names from the gate names of a parsed workspace, for use as 'csv_popnames' in
+    'import_tools.create_pop_tree'. Gate names used by more than one gate path are followed by their parent
+    gate names, ie: 'CD4+ (T Cells)'.
+
+    Parameters
+    ----------
+    df_data : DataFrame
+        Output of 'parse_workspace'
+
+    Returns
+    ----------
+    df_popnames : DataFrame
+        'pop_name' and 'PATH_NAME_XREF' (full column name) columns
+    """
+
+    col_names = [col for col in df_data.columns if ' | ' in col]
+    hiers = [import_tools.parse_col_name(col)[0] for col in col_names]
+
+    pop_names = [hier[-1] for hier in hiers]
+    for depth in range(1, max(len(hier) for hier in hiers)):
+        duplicated = pd.Series(pop_names).duplicated(keep=False)
+        if not duplicated.any():
+            break
+
+        pop_names = [hier[-1] + ' (' + ' > '.join(hier[-depth - 1:-1]) + ')' if dup else pop_name
+                     for hier, pop_name, dup in zip(hiers, pop_names, duplicated)]
+
+    # '/' is used to find nodes by path (see 'PopNode.find_path_or_popname')
+    pop_names = [pop_name.replace('/', '_') for pop_name in pop_names]
+
+    return pd.DataFrame({'pop_name': pop_names, 'PATH_NAME_XREF': col_names})
+
+
+def create_pop_tree_from_workspace(wsp_file, csv_popnames=None, search_string=None, tissue_type=None,
+                                   show_tree=True, keywords=WSP_KEYWORDS, memory_budget=None, csv_virtual=None):
+    """
+    Creates a flowtree from a FlowJo workspace (.wsp) file, instead of from exported CSV tables. The flowtree is
+    the same as the flowtree of 'import_tools.create_pop_tree', and node counts are taken from the workspace.
+
+    Parameters
+    ----------
+    wsp_file : str
+        Path of the FlowJo workspace file
+    csv_popnames : str
+        Optional. Path of the MASTER population names CSV. Default names the populations by their gate names
+        (see 'make_pop_names')
+    search_string : str
+        Optional. Includes the samples with this sub-string in the sample name (ie: 'Tumor')
+    tissue_type : str
+        Optional. 'tissue' attribute of the flowtree nodes
+    show_tree : bool
+        if True, print the flowtree
+    keywords : list[str]
+        FlowJo keywords saved as metadata columns
+    memory_budget : float
+        Optional. Memory budget in MB. If given, population columns are stored as float32 and metadata columns as
+        Categorical Type
+    csv_virtual : str
+        Optional. Path of the virtual population CSV (see 'PopNode.add_virtual_nodes')
+
+    Returns
+    ----------
+    root : object
+        PopNode object, flowtree root
+    """
+
+    df_data, df_counts, _ = parse_workspace(wsp_file, search_string, keywords)
+
+    if memory_budget is not None:
+        df_data = import_tools.downcast_dataframe(df_data)
+
+    if csv_popnames is None:
+        csv_popnames = make_pop_names(df_data)
+
+    root = import_tools.create_pop_tree(csv_popnames, df_data, tissue_type, show_tree, memory_budget, csv_virtual)
+
+    # Counts of the workspace are used, instead of propagating Freq of Parent from the flowtree root
+    for node in [root] + list(root.descendants):
+        path = node.path_name[1:]
+        if isinstance(node, flowtree.VirtualPopNode) or path not in df_counts.columns:
+            continue
+
+        if hasattr(node, 'freq_of_parent'):
+            data = node.freq_of_parent.drop(columns='Data')
+            data['Data'] = df_counts[path].to_numpy(dtype='float64')
+            node.counts = data
+
+    return root